@@ -0,0 +1,505 @@
+import json
+import time
+import random
+import socket
+import threading
+import xml.sax.saxutils
+from xml.etree import ElementTree
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-ins for every service o2z talks to, for benchmarks/run.py
+
+
+# Synthetic OSPF Explorer JSON, shaped like the real thing:
+#    {"areas": {area: {"routers": {ip: {"links": {"router": [...]}}}}}}
+# Router IPs are in 127.0.0.0/8, so the SNMP responder can answer for them
+# all. Routers on area borders show up in more than one area.
+def generate_ospf(n_routers, n_areas=4, mean_links=6, seed=0):
+    rng = random.Random(seed)
+    ips = [
+        f"127.{1 + i // 65025}.{(i // 255) % 255}.{1 + i % 255}"
+        for i in range(n_routers)
+    ]
+    areas = {f"0.0.0.{a}": {"routers": {}} for a in range(n_areas)}
+    for i, ip in enumerate(ips):
+        home = f"0.0.0.{i % n_areas}"
+        in_areas = [home]
+        if rng.random() < 0.05:
+            in_areas.append(f"0.0.0.{rng.randrange(n_areas)}")
+        for area in in_areas:
+            n_links = max(0, int(rng.expovariate(1 / mean_links)))
+            areas[area]["routers"][ip] = {
+                "links": {
+                    "router": [
+                        {"id": rng.choice(ips), "metric": rng.choice([1, 10, 100])}
+                        for _ in range(n_links)
+                    ],
+                    "stubnet": [{"id": f"10.{i % 255}.0.0/24", "metric": 10}],
+                }
+            }
+    return {"areas": areas, "updated": int(time.time())}
+
+
+# Serves a snapshot on /ospf.json with an ETag, and a Zabbix JSON-RPC API on
+# /api_jsonrpc.php that keeps hosts in memory
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        ospf = self.server.ospf
+        if self.headers.get("If-None-Match") == ospf["etag"]:
+            return self._reply(304)
+        self._reply(
+            200,
+            ospf["body"],
+            {"ETag": ospf["etag"], "Content-Type": "application/json"},
+        )
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if isinstance(request, list):
+            response = [self.server.zabbix.call(r) for r in request]
+        else:
+            response = self.server.zabbix.call(request)
+        self._reply(
+            200, json.dumps(response).encode(), {"Content-Type": "application/json"}
+        )
+
+
+class FakeZabbix:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.next_id = 10000
+        self.calls = 0
+        self.logins = 0
+        self.sessions = set()
+
+    def call(self, request):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            method = request["method"]
+            params = request.get("params", {})
+            handler = getattr(self, method.replace(".", "_"), None)
+            if (
+                method not in ("apiinfo.version", "user.login")
+                and request.get("auth") not in self.sessions
+            ):
+                return {
+                    "jsonrpc": "2.0",
+                    "error": {
+                        "code": -32602,
+                        "message": "Invalid params.",
+                        "data": "Session terminated, re-login, please.",
+                    },
+                    "id": request.get("id"),
+                }
+            if handler is None:
+                result = []
+            else:
+                result = handler(params)
+        return {"jsonrpc": "2.0", "result": result, "id": request.get("id")}
+
+    def apiinfo_version(self, params):
+        return "6.0.0"
+
+    def user_login(self, params):
+        self.logins += 1
+        session = f"{random.getrandbits(128):032x}"
+        self.sessions.add(session)
+        return session
+
+    def user_logout(self, params):
+        return True
+
+    def hostgroup_get(self, params):
+        return [{"groupid": "7", "name": "NYCMeshNodes"}]
+
+    def template_get(self, params):
+        names = params.get("filter", {}).get("name")
+        names = [names] if isinstance(names, str) else names or []
+        return [
+            {"templateid": str(10563 + i), "name": name}
+            for i, name in enumerate(sorted(names))
+        ]
+
+    def host_get(self, params):
+        names = params.get("filter", {}).get("host")
+        if names is not None:
+            names = {names} if isinstance(names, str) else set(names)
+            return [h for h in self.hosts.values() if h["host"] in names]
+        hostids = params.get("hostids")
+        if hostids is not None:
+            return [h for h in self.hosts.values() if h["hostid"] in hostids]
+        return list(self.hosts.values())
+
+    def host_create(self, params):
+        hostids = []
+        for p in params if isinstance(params, list) else [params]:
+            self.next_id += 1
+            hostid = str(self.next_id)
+            self.hosts[hostid] = {
+                "hostid": hostid,
+                "host": p["host"],
+                "status": "0",
+                "interfaces": [{"interfaceid": hostid, "ip": p["interfaces"][0]["ip"]}],
+            }
+            hostids.append(hostid)
+        return {"hostids": hostids}
+
+    def host_update(self, params):
+        updated = []
+        for p in params if isinstance(params, list) else [params]:
+            self.hosts[p["hostid"]].update(
+                {k: v for k, v in p.items() if k != "hostid"}
+            )
+            updated.append(p["hostid"])
+        return {"hostids": updated}
+
+    def host_delete(self, params):
+        for hostid in params:
+            self.hosts.pop(hostid, None)
+        return {"hostids": params}
+
+
+def serve_http(ospf, zabbix_latency, ready):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeHandler)
+    body = json.dumps(ospf).encode()
+    server.ospf = {"body": body, "etag": f'"{hash(body)}"'}
+    server.zabbix = FakeZabbix(zabbix_latency)
+    ready.put(server.server_port)
+    server.serve_forever()
+
+
+# Minimal S3: PutObject, multipart uploads, GetObject, ListObjectsV2 and
+# DeleteObjects, path-style
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        # boto3 may send aws-chunked bodies with trailing checksums
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            out, rest = b"", body
+            while True:
+                size_line, rest = rest.split(b"\r\n", 1)
+                size = int(size_line.split(b";")[0], 16)
+                if size == 0:
+                    break
+                out, rest = out + rest[:size], rest[size + 2 :]
+            body = out
+        return body
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self._body()
+        etag = f'"{hash(body) & 0xFFFFFFFF:x}"'
+        if "uploadId" in query:
+            upload = self.server.uploads[query["uploadId"][0]]
+            upload[int(query["partNumber"][0])] = body
+        else:
+            self.server.objects[url.path] = body
+        self._reply(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        body = self._body()
+        if "delete" in query:
+            return self._delete_objects(url.path, body)
+        _, bucket, key = url.path.split("/", 2)
+        if "uploads" in query:
+            upload_id = f"upload-{len(self.server.uploads)}"
+            self.server.uploads[upload_id] = {}
+            xml = (
+                "<InitiateMultipartUploadResult>"
+                f"<Bucket>{bucket}</Bucket><Key>{xml.sax.saxutils.escape(key)}</Key>"
+                f"<UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>"
+            )
+        else:
+            parts = self.server.uploads.pop(query["uploadId"][0])
+            self.server.objects[url.path] = b"".join(parts[n] for n in sorted(parts))
+            xml = (
+                "<CompleteMultipartUploadResult>"
+                f"<Bucket>{bucket}</Bucket><Key>{xml.sax.saxutils.escape(key)}</Key>"
+                '<ETag>"done"</ETag>'
+                "</CompleteMultipartUploadResult>"
+            )
+        self._reply(200, xml.encode(), {"Content-Type": "application/xml"})
+
+    def do_DELETE(self):
+        url = urlparse(self.path)
+        self.server.uploads.pop(parse_qs(url.query).get("uploadId", [""])[0], None)
+        self._reply(204)
+
+    def _delete_objects(self, bucket_path, body):
+        keys = [
+            k.text for k in ElementTree.fromstring(body).iter() if k.tag.endswith("Key")
+        ]
+        self.server.deletes += 1
+        for key in keys:
+            self.server.objects.pop(f"{bucket_path.rstrip('/')}/{key}", None)
+        self._reply(
+            200, b"<DeleteResult></DeleteResult>", {"Content-Type": "application/xml"}
+        )
+
+    def _list_objects(self, bucket, query):
+        self.server.lists += 1
+        prefix = query.get("prefix", [""])[0]
+        delimiter = query.get("delimiter", [None])[0]
+        max_keys = int(query.get("max-keys", [1000])[0])
+        after = query.get("continuation-token", [""])[0]
+
+        entries = []
+        for path in sorted(self.server.objects):
+            key = path.split("/", 2)[2]
+            if not path.startswith(f"/{bucket}/") or not key.startswith(prefix):
+                continue
+            if delimiter and delimiter in key[len(prefix) :]:
+                rest = key[len(prefix) :]
+                key = prefix + rest[: rest.index(delimiter) + 1]
+                if entries and entries[-1] == ("prefix", key):
+                    continue
+                entries.append(("prefix", key))
+            else:
+                entries.append(("key", key))
+        entries = [e for e in entries if e[1] > after]
+        page, truncated = entries[:max_keys], len(entries) > max_keys
+
+        escape = xml.sax.saxutils.escape
+        body = "".join(
+            (
+                f"<Contents><Key>{escape(k)}</Key><Size>1</Size></Contents>"
+                if kind == "key"
+                else f"<CommonPrefixes><Prefix>{escape(k)}</Prefix></CommonPrefixes>"
+            )
+            for kind, k in page
+        )
+        token = (
+            f"<NextContinuationToken>{escape(page[-1][1])}</NextContinuationToken>"
+            if truncated
+            else ""
+        )
+        self._reply(
+            200,
+            (
+                "<ListBucketResult>"
+                f"<Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix>"
+                f"<KeyCount>{len(page)}</KeyCount>"
+                f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>"
+                f"{token}{body}</ListBucketResult>"
+            ).encode(),
+            {"Content-Type": "application/xml"},
+        )
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if "list-type" in query:
+            return self._list_objects(url.path.strip("/"), query)
+        body = self.server.objects.get(url.path)
+        if body is None:
+            return self._reply(404)
+        self._reply(200, body)
+
+
+def serve_s3(ready):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3Handler)
+    server.objects = {}
+    server.uploads = {}
+    server.lists = 0
+    server.deletes = 0
+    ready.put(server.server_port)
+    server.serve_forever()
+
+
+# The protocol API's method names changed case between pysnmp releases
+SNMP_API_NAMES = {
+    "getResponse": "get_response",
+    "getPDU": "get_pdu",
+    "getVarBinds": "get_varbinds",
+    "setVarBinds": "set_varbinds",
+}
+
+
+def _snmp_call(obj, name, *args):
+    fn = getattr(obj, SNMP_API_NAMES.get(name, name), None) or getattr(obj, name)
+    return fn(*args)
+
+
+# Not exported by the socket module on every Python version (Linux value)
+IP_PKTINFO = getattr(socket, "IP_PKTINFO", 8)
+
+
+# Answers SNMP GETs for any address it's sent to, with sysName set to a name
+# derived from the IP. Replies are delayed by `latency` seconds (plus up to
+# `jitter`), and a `loss` fraction of requests are dropped.
+# A MikroTik or a Ubiquiti radio, depending on the address
+def _fake_system_group(p_mod, ip):
+    if sum(map(int, ip.split("."))) % 2 == 0:
+        descr, object_id = "RouterOS RB5009UG+S+", "1.3.6.1.4.1.14988.1"
+    else:
+        descr, object_id = "Linux 2.6.32.71 #1 ubnt XW.v6.3.11", "1.3.6.1.4.1.41112"
+    return {
+        "1.3.6.1.2.1.1.1.0": p_mod.OctetString(descr),
+        "1.3.6.1.2.1.1.2.0": p_mod.ObjectIdentifier(object_id),
+        "1.3.6.1.2.1.1.5.0": p_mod.OctetString(f"nn-{ip.replace('.', '-')}"),
+        "1.3.6.1.2.1.1.6.0": p_mod.OctetString(f"Rooftop {ip}"),
+    }
+
+
+def serve_snmp(port, latency, jitter, loss, ready, seed=0):
+    from pyasn1.codec.ber import decoder, encoder
+    from pysnmp.proto import api
+
+    modules = getattr(api, "PROTOCOL_MODULES", None) or api.protoModules
+    rng = random.Random(seed)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_IP, IP_PKTINFO, 1)
+    sock.bind(("0.0.0.0", port))
+    ready.put(port)
+
+    def respond(msg, addr, local_ip):
+        version = int(_snmp_call(api, "decodeMessageVersion", msg))
+        p_mod = modules[version]
+        req, _ = decoder.decode(msg, asn1Spec=p_mod.Message())
+        rsp = _snmp_call(p_mod.apiMessage, "getResponse", req)
+        req_pdu = _snmp_call(p_mod.apiMessage, "getPDU", req)
+        rsp_pdu = _snmp_call(p_mod.apiMessage, "getPDU", rsp)
+        system = _fake_system_group(p_mod, local_ip)
+        varbinds = [
+            (oid, system.get(str(oid), p_mod.Null()))
+            for oid, _ in _snmp_call(p_mod.apiPDU, "getVarBinds", req_pdu)
+        ]
+        _snmp_call(p_mod.apiPDU, "setVarBinds", rsp_pdu, varbinds)
+        # Reply from the address the request was sent to, like a real router
+        ancillary = [
+            (
+                socket.SOL_IP,
+                IP_PKTINFO,
+                bytes(4) + socket.inet_aton(local_ip) + bytes(4),
+            )
+        ]
+        sock.sendmsg([encoder.encode(rsp)], ancillary, 0, addr)
+
+    while True:
+        msg, ancdata, _, addr = sock.recvmsg(65535, 1024)
+        local_ip = "127.0.0.1"
+        for level, kind, data in ancdata:
+            if level == socket.SOL_IP and kind == IP_PKTINFO:
+                local_ip = socket.inet_ntoa(data[8:12])
+        if rng.random() < loss:
+            continue
+        delay = latency + rng.random() * jitter
+        if delay > 0:
+            threading.Timer(delay, respond, (msg, addr, local_ip)).start()
+        else:
+            respond(msg, addr, local_ip)
+
+
+# Just enough of the Zabbix DB schema for the noisy-trigger queries
+ZABBIX_SCHEMA = """
+DROP TABLE IF EXISTS triggers, events, functions, items, hosts, hosts_groups,
+    event_recovery;
+CREATE TABLE triggers (
+    triggerid bigint PRIMARY KEY, description varchar(255),
+    priority integer, flags integer
+);
+CREATE TABLE events (
+    eventid bigint PRIMARY KEY, source integer, object integer,
+    objectid bigint, clock integer, value integer, ns integer DEFAULT 0
+);
+CREATE INDEX events_1 ON events (source, object, objectid, clock);
+CREATE INDEX events_2 ON events (source, object, clock);
+CREATE TABLE functions (functionid bigint PRIMARY KEY, itemid bigint, triggerid bigint);
+CREATE INDEX functions_1 ON functions (triggerid);
+CREATE INDEX functions_2 ON functions (itemid);
+CREATE TABLE items (itemid bigint PRIMARY KEY, hostid bigint);
+CREATE INDEX items_1 ON items (hostid);
+CREATE TABLE hosts (hostid bigint PRIMARY KEY, name varchar(128));
+CREATE TABLE hosts_groups (hostgroupid bigserial PRIMARY KEY, hostid bigint, groupid bigint);
+CREATE INDEX hosts_groups_1 ON hosts_groups (hostid, groupid);
+CREATE TABLE event_recovery (eventid bigint PRIMARY KEY, r_eventid bigint);
+"""
+
+
+# Fill the schema with n_hosts hosts (all in group_id), each with a couple
+# of triggers over two items, and n_events problem events (each with a
+# recovery) spread over the last `days` days
+def seed_zabbix_db(conn, n_hosts, n_events, group_id=7, days=60, seed=0):
+    import io
+
+    rng = random.Random(seed)
+    now = int(time.time())
+    cursor = conn.cursor()
+    cursor.execute(ZABBIX_SCHEMA)
+
+    def copy(table, rows):
+        buf = io.StringIO("".join("\t".join(map(str, r)) + "\n" for r in rows))
+        cursor.copy_from(buf, table)
+
+    copy("hosts", [(h, f"nn-{h}") for h in range(1, n_hosts + 1)])
+    copy("hosts_groups", [(h, h, group_id) for h in range(1, n_hosts + 1)])
+    copy("items", [(h * 10 + k, h) for h in range(1, n_hosts + 1) for k in range(2)])
+    n_triggers = n_hosts * 2
+    copy(
+        "triggers",
+        [
+            (t, f"Trigger {t % 50} on {{HOST.NAME}}", rng.choice([2, 3, 4, 5]), 0)
+            for t in range(1, n_triggers + 1)
+        ],
+    )
+    copy(
+        "functions",
+        [
+            (t * 10 + k, ((t - 1) // 2 + 1) * 10 + k, t)
+            for t in range(1, n_triggers + 1)
+            for k in range(2)
+        ],
+    )
+
+    events = []
+    recoveries = []
+    for i in range(n_events):
+        # Some triggers are a lot noisier than others
+        t = min(
+            n_triggers, int(rng.paretovariate(1.2)) + rng.randrange(n_triggers) // 8
+        )
+        clock = now - rng.randrange(days * 86400)
+        events.append((2 * i + 1, 0, 0, t, clock, 1, 0))
+        events.append((2 * i + 2, 0, 0, t, clock + rng.randrange(60, 7200), 0, 0))
+        recoveries.append((2 * i + 1, 2 * i + 2))
+    copy("events", events)
+    copy("event_recovery", recoveries)
+    cursor.execute("ANALYZE")
+    conn.commit()
+    cursor.close()
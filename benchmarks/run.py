@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import multiprocessing
+from prettytable import PrettyTable
+
+# END-TO-END BENCHMARK
+# Runs the enroll and noisy-triggers paths against local stand-ins for every
+# service o2z talks to, and reports wall time, throughput and peak (Python)
+# memory for each stage:
+#    - a synthetic OSPF snapshot, served with an ETag
+#    - a fake Zabbix JSON-RPC API that keeps hosts in memory
+#    - an SNMP responder with configurable latency and loss
+#    - a seeded Postgres with the bits of the Zabbix schema we query
+#      (needs the `pgserver` package, otherwise those stages are skipped)
+#    - a minimal S3
+# Save results with --json and compare a later run against them with
+# --compare, to see how a change moved the numbers.
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import fakes
+
+
+class Bench:
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.results = []
+
+    # Time fn(), which processes `items` things. Returns what fn() returned.
+    def stage(self, name, items, fn):
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = fn()
+        finally:
+            wall = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if self.memory else None
+            tracemalloc.stop()
+        self.results.append(
+            {
+                "stage": name,
+                "items": items,
+                "wall_s": wall,
+                "per_s": items / wall if wall > 0 else None,
+                "peak_mb": peak / 1024 / 1024 if peak is not None else None,
+            }
+        )
+        logging.info(f"{name}: {wall:.3f}s")
+        return result
+
+    def table(self, previous=None):
+        previous = {r["stage"]: r for r in previous or []}
+        t = PrettyTable()
+        fields = ["Stage", "Items", "Wall (s)", "Items/s", "Peak MB"]
+        if previous:
+            fields.append("Wall vs before")
+        t.field_names = fields
+        t.align = "r"
+        t.align["Stage"] = "l"
+        for r in self.results:
+            row = [
+                r["stage"],
+                r["items"],
+                f"{r['wall_s']:.3f}",
+                f"{r['per_s']:.0f}" if r["per_s"] else "-",
+                f"{r['peak_mb']:.1f}" if r["peak_mb"] is not None else "-",
+            ]
+            if previous:
+                before = previous.get(r["stage"])
+                row.append(
+                    f"{(r['wall_s'] / before['wall_s'] - 1) * 100:+.0f}%"
+                    if before
+                    else "-"
+                )
+            t.add_row(row)
+        return t
+
+
+def start_service(target, *args):
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(*args, ready), daemon=True)
+    process.start()
+    return process, ready.get(timeout=30)
+
+
+def bench_enroll(bench, args):
+    import snmp
+    from explorer import O2ZExplorer
+    from zabbix import O2ZZabbix
+
+    snapshot = fakes.generate_ospf(args.routers)
+    _, http_port = start_service(fakes.serve_http, snapshot, args.zabbix_latency)
+    start_service(
+        fakes.serve_snmp, args.snmp_port, args.snmp_latency, 0.01, args.snmp_loss
+    )
+    os.environ.update(
+        {
+            "P2Z_OSPF_API_URL": f"http://127.0.0.1:{http_port}/ospf.json",
+            "P2Z_OSPF_CACHE_MAX_AGE": "0",
+            "P2Z_ZABBIX_URL": f"http://127.0.0.1:{http_port}",
+            "P2Z_ZABBIX_UNAME": "bench",
+            "P2Z_ZABBIX_PWORD": "bench",
+            "P2Z_SNMP_PORT": str(args.snmp_port),
+            "P2Z_SNMP_TIMEOUT": str(args.snmp_timeout),
+            "P2Z_SNMP_RETRIES": "1",
+            "P2Z_SNMP_CONCURRENCY": str(args.snmp_concurrency),
+        }
+    )
+
+    routes = bench.stage(
+        "ospf fetch + parse", args.routers, lambda: O2ZExplorer().fetch_ospf_routes()
+    )
+    bench.stage(
+        "ospf revalidate (304)",
+        args.routers,
+        lambda: O2ZExplorer().fetch_ospf_routes(),
+    )
+    e = O2ZExplorer()
+    e.stream = False
+    e.snapshot_changed = True
+    bench.stage(
+        "ospf parse (whole document)",
+        args.routers,
+        lambda: e.extract_routes_count(e.fetch_ospf_json()),
+    )
+
+    topology = bench.stage(
+        "topology build", args.routers, lambda: e.load_ospf_topology()
+    )
+    bench.stage(
+        "topology degree thresholds",
+        args.routers,
+        lambda: topology.count_at_least([1, 5, 10, 20]),
+    )
+    bench.stage(
+        "topology articulation points",
+        args.routers,
+        lambda: topology.articulation_points(),
+    )
+    bench.stage(
+        "topology betweenness (32 samples)",
+        args.routers,
+        lambda: topology.betweenness(samples=32),
+    )
+
+    popular = [ip for ip, ct in routes.items() if ct >= args.link_floor]
+    bench.stage(
+        "snmp resolve",
+        len(popular),
+        lambda: snmp.snmp_get_hostnames(
+            popular,
+            concurrency=args.snmp_concurrency,
+            timeout=args.snmp_timeout,
+            retries=1,
+            port=args.snmp_port,
+        ),
+    )
+
+    z = O2ZZabbix()
+    bench.stage(
+        "enroll (everything new)",
+        len(popular),
+        lambda: z.enroll_popular_devices(args.link_floor, refresh_snmp=True),
+    )
+    bench.stage(
+        "enroll (nothing new)",
+        len(popular),
+        lambda: z.enroll_popular_devices(args.link_floor),
+    )
+    bench.stage(
+        "enroll (critical routers)",
+        len(topology.critical()),
+        lambda: z.enroll_popular_devices(args.link_floor, critical=1),
+    )
+
+    # Some hosts for routers that are gone from OSPF
+    from reconcile import O2ZReconciler
+
+    stale = [
+        z.snmp_host_params(f"10.255.{i // 256}.{i % 256}", f"gone-{i}", "7", 10563)
+        for i in range(max(1, len(popular) // 10))
+    ]
+    z.zapi.host.create(*stale)
+    bench.stage(
+        "reconcile (disable gone hosts)",
+        len(stale),
+        lambda: O2ZReconciler(z).reconcile(routes.keys()),
+    )
+    bench.stage(
+        "reconcile (delete after grace)",
+        len(stale),
+        lambda: O2ZReconciler(z, grace_days=0).reconcile(routes.keys()),
+    )
+
+
+def bench_triggers(bench, args):
+    try:
+        import pgserver
+    except ImportError:
+        logging.warning("pgserver is not installed. Skipping the trigger stages.")
+        return
+    import psycopg2
+    from triggers import O2ZTriggers
+
+    server = pgserver.get_server(os.path.join(args.workdir, "pg"), cleanup_mode="stop")
+    socket_dir = server.get_uri().split("host=")[1]
+    os.environ.update(
+        {
+            "P2Z_PGSQL_HOST": socket_dir,
+            "P2Z_PGSQL_DB": "postgres",
+            "P2Z_PGSQL_UNAME": "postgres",
+            "P2Z_PGSQL_PWORD": "",
+        }
+    )
+    conn = psycopg2.connect(host=socket_dir, dbname="postgres", user="postgres")
+    bench.stage(
+        "seed zabbix db",
+        args.events,
+        lambda: fakes.seed_zabbix_db(conn, args.hosts, args.events),
+    )
+    conn.close()
+
+    t = O2ZTriggers()
+    bench.stage(
+        "noisy triggers (7 days)",
+        args.events,
+        lambda: t.get_noisiest_triggers(7, 7, 20),
+    )
+    bench.stage(
+        "noisy triggers (30 days)",
+        args.events,
+        lambda: t.get_noisiest_triggers(7, 30, 20),
+    )
+    bench.stage(
+        "noisy triggers (1,7,30 windows)",
+        args.events,
+        lambda: t.get_noisiest_triggers_windows(7, [1, 7, 30], 20),
+    )
+    rollup = O2ZTriggers(rollup=True)
+    bench.stage(
+        "noisy triggers rollup (cold)",
+        args.events,
+        lambda: rollup.get_noisiest_triggers(7, 30, 20),
+    )
+    bench.stage(
+        "noisy triggers rollup (warm)",
+        args.events,
+        lambda: rollup.get_noisiest_triggers(7, 30, 20),
+    )
+    bench.stage(
+        "full trigger dump",
+        args.events,
+        lambda: sum(1 for _ in t.iter_noisiest_triggers(7, 60)),
+    )
+    bench.stage(
+        "flapping triggers (30 days)",
+        args.events,
+        lambda: t.get_flappiest_triggers(7, 30, 20),
+    )
+    bench.stage(
+        "full flap dump",
+        args.events,
+        lambda: sum(1 for _ in t.iter_flapping_triggers(7, 60)),
+    )
+
+
+def bench_s3(bench, args):
+    from bucket import O2ZBucket
+    from triggers import O2ZTriggerRow
+
+    _, s3_port = start_service(fakes.serve_s3)
+    os.environ.update(
+        {
+            "P2Z_S3_ENDPOINT_URL": f"http://127.0.0.1:{s3_port}",
+            "P2Z_S3_ACCESS_KEY": "bench",
+            "P2Z_S3_SECRET_KEY": "bench",
+            "P2Z_S3_BUCKET": "bench",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "P2Z_CSV_TITLE": "bench",
+        }
+    )
+
+    def rows():
+        for i in range(args.rows):
+            yield O2ZTriggerRow(
+                f"nn-{i % 2000}", f"Trigger {i % 50} fired", 3 + i % 3, i
+            )
+
+    s3 = O2ZBucket()
+    s3.gzip = False
+    bench.stage(
+        "s3 publish csv",
+        args.rows,
+        lambda: s3.publish_full_noise_report(rows()),
+    )
+    s3.gzip = True
+    bench.stage(
+        "s3 publish csv (gzip)",
+        args.rows,
+        lambda: s3.publish_full_noise_report(rows()),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="o2z end-to-end benchmark")
+    parser.add_argument("--routers", type=int, default=1000)
+    parser.add_argument("--link-floor", type=int, default=10)
+    parser.add_argument("--snmp-latency", type=float, default=0.02)
+    parser.add_argument("--snmp-loss", type=float, default=0.01)
+    parser.add_argument("--snmp-timeout", type=float, default=0.5)
+    parser.add_argument("--snmp-concurrency", type=int, default=64)
+    parser.add_argument("--snmp-port", type=int, default=16161)
+    parser.add_argument("--zabbix-latency", type=float, default=0.005)
+    parser.add_argument("--hosts", type=int, default=500)
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument(
+        "--stages",
+        type=str,
+        default="enroll,triggers,s3",
+        help="Comma separated stages to run",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Don't trace memory (tracemalloc slows everything down)",
+    )
+    parser.add_argument("--json", type=str, help="Save the results to this file")
+    parser.add_argument(
+        "--compare", type=str, help="Compare against results saved with --json"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    args.workdir = tempfile.mkdtemp(prefix="o2z-bench-")
+    os.environ["P2Z_CACHE_DIR"] = os.path.join(args.workdir, "cache")
+
+    bench = Bench(memory=not args.no_memory)
+    stages = args.stages.split(",")
+    try:
+        if "enroll" in stages:
+            bench_enroll(bench, args)
+        if "triggers" in stages:
+            bench_triggers(bench, args)
+        if "s3" in stages:
+            bench_s3(bench, args)
+    finally:
+        shutil.rmtree(args.workdir, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+    print(bench.table(previous))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": bench.results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
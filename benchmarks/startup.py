@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+# STARTUP BENCHMARK
+# Checks that importing main.py stays cheap, by timing it with
+# `python -X importtime` and making sure none of the heavy dependencies get
+# pulled in before a subcommand is dispatched. Exits non-zero when over budget,
+# so it can run in CI and catch import creep.
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only the subcommands that need these should ever import them
+HEAVY_MODULES = ["boto3", "psycopg2", "pysnmp", "pyzabbix", "slack_sdk", "ijson"]
+
+# The modules each subcommand loads when it's dispatched
+SUBCOMMAND_MODULES = {
+    "enroll": ["zabbix"],
+    "noisy-triggers": ["zabbix", "triggers", "bucket", "slack", "publish"],
+    "bucket": ["bucket"],
+    "slack": ["slack"],
+    "serve": ["daemon", "bucket", "slack", "publish"],
+}
+
+
+# Cumulative import time, in microseconds, of each module in `modules`
+def import_time(modules, code=None):
+    if code is None:
+        code = f"import {', '.join(modules)}"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() in modules and name[1:2] != " ":
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="o2z startup-time benchmark")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=float(os.getenv("P2Z_STARTUP_BUDGET_MS", default=50)),
+        help="Most that importing main.py may take, in milliseconds",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=5, help="Take the median of this many runs"
+    )
+    args = parser.parse_args()
+
+    main_ms = statistics.median(
+        import_time(["main"])["main"] / 1000 for _ in range(args.runs)
+    )
+    print(f"import main: {main_ms:.1f} ms (budget {args.budget_ms:.1f} ms)")
+
+    for subcommand, modules in SUBCOMMAND_MODULES.items():
+        sub_ms = sum(import_time(modules).values()) / 1000
+        print(f"  + {subcommand}: {sub_ms:.1f} ms when dispatched")
+
+    leaked = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, main; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))",
+        ],
+        cwd=REPO,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+
+    failed = False
+    if len(leaked) > 0:
+        print(f"FAIL: importing main.py pulls in {', '.join(leaked)}")
+        failed = True
+    if main_ms > args.budget_ms:
+        print(f"FAIL: importing main.py is over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,125 @@
+import io
 import os
+import csv
+import gzip
+import sys
 import time
 import logging
+import threading
+import calendar
+import datetime
 import boto3
 import botocore.exceptions
 
+# S3 won't take multipart upload parts smaller than this, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# delete_objects takes at most this many keys per request
+MAX_DELETE_KEYS = 1000
+
+# Where the dated reports live, as <root>YYYY/MM/DD/<report>
+REPORT_ROOTS = ["zabbix/csv/", "zabbix/pretty/"]
+
+
+# A write-only file that uploads what's written to it to S3.
+# Small bodies go up in one put_object when the file is closed. Once more than
+# `multipart_threshold` bytes have been written, it switches to a multipart
+# upload, and sends each part as soon as it fills up.
+# abort() can be called from another thread, to give up on an upload that's
+# taking too long.
+class O2ZBucketUpload(io.RawIOBase):
+    def __init__(
+        self,
+        s3_client,
+        bucket,
+        key,
+        multipart_threshold=8 * 1024 * 1024,
+        **object_args,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(multipart_threshold, MIN_PART_SIZE)
+        self.object_args = object_args
+        self.buf = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.aborted = False
+        self._lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        with self._lock:
+            # Whatever's still flushed through after an abort goes nowhere
+            if self.aborted:
+                return len(b)
+            self.buf += b
+            if len(self.buf) >= self.part_size:
+                self._upload_part()
+        return len(b)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.object_args
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buf),
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.buf.clear()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            with self._lock:
+                self._finish()
+        except botocore.exceptions.ClientError:
+            self.abort()
+            raise
+        finally:
+            super().close()
+
+    def _finish(self):
+        if self.aborted:
+            return
+        if self.upload_id is None:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self.buf),
+                **self.object_args,
+            )
+        else:
+            if len(self.buf) > 0:
+                self._upload_part()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+
+    # Throw away whatever was uploaded so far. Nothing gets written after
+    # this, not even when close() is called.
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            self.buf.clear()
+            if self.upload_id is not None:
+                self.s3_client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+                )
+                self.upload_id = None
+
 
 class O2ZBucket:
     def __init__(self):
@@ -11,70 +127,263 @@ class O2ZBucket:
         secret_key = os.getenv("P2Z_S3_SECRET_KEY", default="")
         region = os.getenv("P2Z_S3_REGION", default="us-east-1")
         self.bucket = os.getenv("P2Z_S3_BUCKET", default="")
+        # For S3-compatible stores other than AWS
+        endpoint_url = os.getenv("P2Z_S3_ENDPOINT_URL") or None
 
         self.s3 = boto3.resource(
-            "s3", aws_access_key_id=access_key, aws_secret_access_key=secret_key
+            "s3",
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            endpoint_url=endpoint_url,
         )
         self.s3_client = boto3.client(
-            "s3", aws_access_key_id=access_key, aws_secret_access_key=secret_key
+            "s3",
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            endpoint_url=endpoint_url,
         )
+        self.gzip = True if os.getenv("P2Z_S3_GZIP") else False
+        self.multipart_threshold = int(
+            os.getenv("P2Z_S3_MULTIPART_THRESHOLD", default=8 * 1024 * 1024)
+        )
+
+    # Print the keys under `prefix`. With since/until (datetime.dates,
+    # inclusive), `prefix` is a report root, and only the reports dated in
+    # that range are listed.
+    def list_objects(self, prefix="", since=None, until=None):
+        for key in self.list_keys(prefix, since, until):
+            print(key)
+
+    def list_keys(self, prefix="", since=None, until=None):
+        if since is None and until is None:
+            yield from self.iter_keys(prefix)
+            return
+        for date_prefix in self.date_prefixes(prefix, since, until):
+            yield from self.iter_keys(date_prefix)
+
+    # Every key under `prefix`, a page (of up to 1000) at a time
+    def iter_keys(self, prefix=""):
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for o in page.get("Contents", []):
+                yield o["Key"]
 
-    def list_objects(self):
-        objects = self.s3.Bucket(self.bucket).objects.all()
-        for o in objects:
-            print(o.key)
+    # The "directories" right under `prefix`
+    def iter_common_prefixes(self, prefix):
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=prefix, Delimiter="/"
+        ):
+            for p in page.get("CommonPrefixes", []):
+                yield p["Prefix"]
+
+    # The fewest root/YYYY/, root/YYYY/MM/ and root/YYYY/MM/DD/ prefixes that
+    # cover the reports dated from `since` to `until` (inclusive, either can
+    # be None). Walks down the date "directories" with delimited listings,
+    # and only opens the years and months that are partly in the range, so
+    # a whole year of reports costs one listing instead of hundreds of keys.
+    def date_prefixes(self, root, since=None, until=None):
+        def walk(prefix, parts):
+            for p in self.iter_common_prefixes(prefix):
+                try:
+                    node = [*parts, int(p[len(prefix) : -1])]
+                    first, last = _date_span(node)
+                except ValueError:
+                    # Not part of the date layout
+                    continue
+                if (since is not None and last < since) or (
+                    until is not None and first > until
+                ):
+                    continue
+                if (since is None or first >= since) and (
+                    until is None or last <= until
+                ):
+                    yield p
+                elif len(node) < 3:
+                    yield from walk(p, node)
+
+        yield from walk(root, [])
 
     def print_objects(self, obj):
         logging.debug(obj)
         response = self.s3_client.get_object(Bucket=self.bucket, Key=obj)
         logging.debug(response)
-        print(response["Body"].read().decode("utf-8"))
+        body = response["Body"].read()
+        if response.get("ContentEncoding") == "gzip":
+            body = gzip.decompress(body)
+        print(body.decode("utf-8"))
+
+    # Delete any number of keys (any iterable, like list_keys), up to
+    # MAX_DELETE_KEYS per request. Returns how many were deleted.
+    def delete_keys(self, keys, dry_run=False):
+        deleted = 0
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) == MAX_DELETE_KEYS:
+                deleted += self._delete_batch(batch, dry_run)
+                batch = []
+        if len(batch) > 0:
+            deleted += self._delete_batch(batch, dry_run)
+        return deleted
+
+    def _delete_batch(self, keys, dry_run):
+        if dry_run:
+            for key in keys:
+                print(f"Would delete {key}")
+            return len(keys)
+
+        response = self.s3_client.delete_objects(
+            Bucket=self.bucket,
+            Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True},
+        )
+        errors = response.get("Errors", [])
+        for e in errors:
+            logging.error(f"Could not delete {e['Key']}: {e['Code']} {e['Message']}")
+        logging.info(f"Deleted {len(keys) - len(errors)} objects")
+        return len(keys) - len(errors)
+
+    # Delete the dated reports older than `keep_days` days (today is day 1)
+    def prune(self, keep_days, roots=None, dry_run=False):
+        if keep_days < 1:
+            raise ValueError("Must keep at least one day of reports!")
+        until = datetime.datetime.now(datetime.timezone.utc).date() - (
+            datetime.timedelta(days=keep_days)
+        )
+        keys = (
+            key
+            for root in (REPORT_ROOTS if roots is None else roots)
+            for prefix in self.date_prefixes(root, until=until)
+            for key in self.iter_keys(prefix)
+        )
+        deleted = self.delete_keys(keys, dry_run)
+        logging.info(f"Pruned {deleted} objects dated {until} or earlier")
+        return deleted
+
+    # Stream CSV rows to an S3 object (or to stdout, with test=True) through
+    # the csv module, without ever holding the whole body in memory. `rows`
+    # can be any iterable of tuples, like a DB cursor.
+    # If gzip is on, the body is compressed and stored with
+    # Content-Encoding: gzip.
+    # While it's being written, the upload is kept in `uploads` (if given), so
+    # abort_uploads() can give up on it from another thread.
+    def publish_csv(self, key, header, rows, test=False, uploads=None):
+        if test:
+            print(key)
+            writer = csv.writer(sys.stdout)
+            writer.writerow(header)
+            writer.writerows(rows)
+            return
+
+        object_args = {"ContentType": "text/csv"}
+        if self.gzip:
+            object_args["ContentEncoding"] = "gzip"
+        upload = O2ZBucketUpload(
+            self.s3_client,
+            self.bucket,
+            key,
+            multipart_threshold=self.multipart_threshold,
+            **object_args,
+        )
+        if uploads is not None:
+            uploads.append(upload)
+        buffered = io.BufferedWriter(upload)
+        f = buffered
+        if self.gzip:
+            f = gzip.GzipFile(fileobj=buffered, mode="wb")
+        text = io.TextIOWrapper(f, encoding="utf-8", newline="")
 
-    def delete_object(self, obj):
         try:
-            logging.debug(obj)
-            response = self.s3_client.delete_object(Bucket=self.bucket, Key=obj)
-            logging.info(response)
-        except botocore.exceptions.ClientError as e:
-            logging.error(e)
+            writer = csv.writer(text)
+            writer.writerow(header)
+            writer.writerows(rows)
+        except Exception:
+            upload.abort()
+            raise
+        finally:
+            try:
+                text.close()
+                # GzipFile doesn't close the file it wraps
+                buffered.close()
+            finally:
+                if uploads is not None:
+                    uploads.remove(upload)
 
-    # Publishes reports to:
-    #    s3://mesh-support-reports/zabbix/csv/YYYY/MM/DD/noisiest.csv
-    # Optionally, publishes the pretty-printed version to:
-    #    s3://mesh-support-reports/zabbix/pretty/YYYY/MM/DD/noisiest.csv
-    def publish_noise_reports(self, triggers, pretty=False, test=False):
+    # Abort every upload still in `uploads` (see publish_csv), so a report
+    # that's being given up on doesn't leave an incomplete multipart upload
+    # behind in the bucket
+    @staticmethod
+    def abort_uploads(uploads):
+        for upload in list(uploads):
+            try:
+                upload.abort()
+                logging.warning(f"Aborted the upload to {upload.key}")
+            except botocore.exceptions.ClientError as e:
+                logging.error(f"Could not abort the upload to {upload.key}: {e}")
+
+    # The CSV header, from P2Z_CSV_TITLE
+    @staticmethod
+    def csv_header():
         title = os.getenv("P2Z_CSV_TITLE")
         if title is None:
             raise ValueError(
                 "P2Z_CSV_TITLE is not set. Please set a title for this data!"
             )
+        return [c.strip() for c in title.split(",") if c.strip() != ""]
+
+    # YYYY/MM/DD/ of today, for report paths
+    @staticmethod
+    def date_prefix():
         t = time.gmtime()
-        t_string = f"{t.tm_year}/{t.tm_mon}/{t.tm_mday}"
-        t_string = "".join(f"{x.zfill(2)}/" for x in t_string.split("/"))
-        csv_path = f"zabbix/csv/{t_string}noisiest.csv"
+        return f"{t.tm_year:04}/{t.tm_mon:02}/{t.tm_mday:02}/"
 
-        # Assemble CSV to push
-        body = f"{title}\n"
-        for t in triggers.trigger_list:
-            body += f"{t.host}, {t.description}, {t.priority}, {t.count},\n"
+    # Publishes reports to:
+    #    s3://mesh-support-reports/zabbix/csv/YYYY/MM/DD/noisiest.csv
+    # Optionally, publishes the pretty-printed version to:
+    #    s3://mesh-support-reports/zabbix/pretty/YYYY/MM/DD/noisiest.csv
+    # Like the other publish_* methods, a failed upload is logged and
+    # re-raised, so the publisher counts it as failed.
+    def publish_noise_reports(self, triggers, pretty=False, test=False):
+        header = self.csv_header()
+        t_string = self.date_prefix()
 
-        if test:
-            print(csv_path)
-            print(body)
-            return
+        if triggers.windows is not None:
+            # One CSV with every window's leaderboard in it
+            csv_path = f"zabbix/csv/{t_string}noisiest_windows.csv"
+            header = ["window", *header, "change"]
+            rows = (
+                (w, t.host, t.description, t.priority, t.count, t.delta)
+                for w, window_rows in triggers.windows.items()
+                for t in window_rows
+            )
+        else:
+            csv_path = f"zabbix/csv/{t_string}noisiest.csv"
+            rows = (
+                (t.host, t.description, t.priority, t.count)
+                for t in triggers.trigger_list
+            )
 
         # Publish CSV data to S3
         try:
-            self.s3_client.put_object(Bucket=self.bucket, Key=csv_path, Body=body)
-            logging.info(f"Objects successfully reported to {csv_path}")
+            self.publish_csv(csv_path, header, rows, test=test)
+            if not test:
+                logging.info(f"Objects successfully reported to {csv_path}")
         except botocore.exceptions.ClientError as e:
             logging.error(f"Could not upload csv data to S3: {e}")
+            raise
+
+        if test:
+            return
 
         if pretty:
             pretty_path = f"zabbix/pretty/{t_string}noisiest.csv"
 
             # We do this rigamarole so we can check the assertion
-            pretty_triggers = triggers.pretty_print()
+            if triggers.windows is not None:
+                pretty_path = f"zabbix/pretty/{t_string}noisiest_windows.csv"
+                pretty_triggers = triggers.pretty_print_windows()
+            else:
+                pretty_triggers = triggers.pretty_print()
             assert pretty_triggers is not None
             pretty_triggers = f"{pretty_triggers}"
 
@@ -85,3 +394,69 @@ class O2ZBucket:
                 logging.info(f"Objects successfully reported to {pretty_path}")
             except botocore.exceptions.ClientError as e:
                 logging.error(f"Could not upload pretty data to S3: {e}")
+                raise
+
+    # Publishes every noisy trigger, not just the leaderboard, to:
+    #    s3://mesh-support-reports/zabbix/csv/YYYY/MM/DD/noisiest_full.csv
+    # `triggers` is streamed straight through, so it can come off a DB cursor
+    # (like O2ZTriggers.iter_noisiest_triggers()). `uploads` is passed on to
+    # publish_csv.
+    def publish_full_noise_report(self, triggers, test=False, uploads=None):
+        csv_path = f"zabbix/csv/{self.date_prefix()}noisiest_full.csv"
+        rows = ((t.host, t.description, t.priority, t.count) for t in triggers)
+        try:
+            self.publish_csv(
+                csv_path, self.csv_header(), rows, test=test, uploads=uploads
+            )
+            if not test:
+                logging.info(f"Objects successfully reported to {csv_path}")
+        except botocore.exceptions.ClientError as e:
+            logging.error(f"Could not upload full csv data to S3: {e}")
+            raise
+
+    # Publishes the flap statistics of every noisy trigger to:
+    #    s3://mesh-support-reports/zabbix/csv/YYYY/MM/DD/flapping.csv
+    # `flaps` is streamed straight through, and `uploads` is passed on to
+    # publish_csv, like in publish_full_noise_report
+    def publish_flap_report(self, flaps, test=False, uploads=None):
+        csv_path = f"zabbix/csv/{self.date_prefix()}flapping.csv"
+        header = [
+            "host",
+            "description",
+            "priority",
+            "problems",
+            "flaps",
+            "mean duration (s)",
+            "mean re-fire (s)",
+        ]
+        rows = (
+            (
+                f.host,
+                f.description,
+                f.priority,
+                f.problems,
+                f.flaps,
+                "" if f.mean_duration is None else round(f.mean_duration),
+                "" if f.mean_refire is None else round(f.mean_refire),
+            )
+            for f in flaps
+        )
+        try:
+            self.publish_csv(csv_path, header, rows, test=test, uploads=uploads)
+            if not test:
+                logging.info(f"Objects successfully reported to {csv_path}")
+        except botocore.exceptions.ClientError as e:
+            logging.error(f"Could not upload flap csv data to S3: {e}")
+            raise
+
+
+# The first and last day covered by [year], [year, month] or
+# [year, month, day]. Raises ValueError if that's not a real date.
+def _date_span(parts):
+    year, month, day = (parts + [None, None])[:3]
+    if month is None:
+        return datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+    if day is None:
+        last_day = calendar.monthrange(year, month)[1]
+        return datetime.date(year, month, 1), datetime.date(year, month, last_day)
+    return (datetime.date(year, month, day),) * 2
@@ -0,0 +1,44 @@
+import os
+import stat
+import tempfile
+
+
+# Where o2z keeps anything that should outlive a single run. That includes
+# the Zabbix session token, so it has to be private: the default is a
+# per-user directory created with mode 0700, and any directory that someone
+# else owns or could write to (and so plant symlinks in) is refused.
+def cache_dir():
+    path = os.getenv("P2Z_CACHE_DIR", default="")
+    if path == "":
+        path = _default_cache_dir()
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        raise PermissionError(f"Cache dir {path} is a symlink")
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f"Cache dir {path} is not a directory")
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise PermissionError(f"Cache dir {path} is owned by someone else")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(
+            f"Cache dir {path} is writable by other users. "
+            f"Run chmod 700 {path}, or point P2Z_CACHE_DIR somewhere private."
+        )
+    return path
+
+
+# $XDG_CACHE_HOME/o2z (~/.cache/o2z), or a per-user directory under /tmp if
+# there's no home to put it in
+def _default_cache_dir():
+    base = os.getenv("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    if base.startswith("~") or not os.access(os.path.dirname(base), os.W_OK):
+        uid = os.getuid() if hasattr(os, "getuid") else os.getpid()
+        return os.path.join(tempfile.gettempdir(), f"o2z-{uid}")
+    return os.path.join(base, "o2z")
+
+
+def cache_path(name):
+    return os.path.join(cache_dir(), name)
@@ -0,0 +1,56 @@
+import os
+import json
+import time
+import threading
+from cache import cache_path
+
+
+# An append-only log of how far each router got through an enrollment run,
+# one JSON line per step, flushed as it's written. If a run is interrupted,
+# the next one can read it back and pick up where it stopped. A line only
+# ever gets appended, so a crash can at worst cut off the last one.
+class O2ZCheckpoint:
+    def __init__(self, path=None):
+        if path is None:
+            path = cache_path("enroll.checkpoint.jsonl")
+        self.path = path
+        self._lock = threading.Lock()
+        self._f = None
+
+    # The latest record of every router, as a dict of IP -> record
+    def load(self):
+        records = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Cut off by a crash
+                        continue
+                    records[record["ip"]] = record
+        except FileNotFoundError:
+            pass
+        return records
+
+    def record(self, ip, status, **fields):
+        line = json.dumps({"ip": ip, "status": status, "at": time.time(), **fields})
+        with self._lock:
+            if self._f is None:
+                self._f = open(self.path, "a")
+            self._f.write(line + "\n")
+            self._f.flush()
+
+    # Start over
+    def clear(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+from zabbix import O2ZZabbix
+from triggers import O2ZTriggers
+from metrics import metrics
+
+
+# A long-running scheduler for o2z jobs. Keeps an authenticated Zabbix
+# session and a DB connection (and everything they've cached) around between
+# runs, instead of paying for them on every cold start.
+# Every job gets its own clients, so one job's failure can throw its clients
+# away without pulling them out from under another job that's still running.
+class O2ZDaemon:
+    def __init__(self):
+        self.jobs = []
+        # job name -> {"zabbix": O2ZZabbix, "triggers": O2ZTriggers}
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    # Run `job` every `interval` seconds, starting right away.
+    # An interval of 0 (or less) disables the job.
+    def add_job(self, name, interval, job):
+        if interval <= 0:
+            logging.info(f"Not scheduling {name}")
+            return
+        self.jobs.append(
+            {
+                "name": name,
+                "interval": interval,
+                "job": job,
+                "lock": threading.Lock(),
+                "next_run": time.monotonic(),
+            }
+        )
+
+    # The job's Zabbix session, logging in again if a previous run threw it
+    # away
+    def zabbix(self, job):
+        with self._clients_lock:
+            clients = self._clients.setdefault(job, {})
+            if clients.get("zabbix") is None:
+                clients["zabbix"] = O2ZZabbix()
+            return clients["zabbix"]
+
+    # The job's DB connection, reconnecting if it was closed
+    def triggers(self, job, rollup=False):
+        with self._clients_lock:
+            clients = self._clients.setdefault(job, {})
+            triggers = clients.get("triggers")
+            if triggers is None or triggers.conn.closed:
+                clients["triggers"] = triggers = O2ZTriggers(rollup=rollup)
+            return triggers
+
+    # Throw away the job's clients, so its next run starts fresh
+    def _reset_clients(self, job):
+        with self._clients_lock:
+            clients = self._clients.pop(job, {})
+        if clients.get("triggers") is not None:
+            clients["triggers"].conn.close()
+
+    # End the job's DB transaction, so its connection doesn't sit "idle in
+    # transaction" (holding locks on events, triggers and hosts) until the
+    # next run. Prepared statements outlive the transaction.
+    def _end_transaction(self, job):
+        with self._clients_lock:
+            triggers = self._clients.get(job, {}).get("triggers")
+        if triggers is not None and not triggers.conn.closed:
+            try:
+                triggers.conn.rollback()
+            except Exception:
+                logging.exception(f"Could not end {job}'s DB transaction")
+
+    def _run_job(self, job):
+        # Skip this run if the last one is still going
+        if not job["lock"].acquire(blocking=False):
+            logging.warning(f"{job['name']} is still running. Skipping this run.")
+            return
+        try:
+            logging.info(f"Running {job['name']}...")
+            start = time.monotonic()
+            with metrics.run(job["name"]):
+                job["job"]()
+            logging.info(f"{job['name']} finished in {time.monotonic() - start:.1f}s")
+        except Exception:
+            # A bad run shouldn't take the daemon down with it
+            logging.exception(f"{job['name']} failed")
+            self._reset_clients(job["name"])
+        finally:
+            self._end_transaction(job["name"])
+            metrics.export()
+            job["lock"].release()
+
+    def run(self):
+        if len(self.jobs) == 0:
+            logging.error("No jobs to run!")
+            return
+
+        logging.info(f"Serving {', '.join(j['name'] for j in self.jobs)}")
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for job in self.jobs:
+                if now >= job["next_run"]:
+                    job["next_run"] = now + job["interval"]
+                    threading.Thread(
+                        target=self._run_job,
+                        args=(job,),
+                        name=f"o2z-{job['name']}",
+                        daemon=True,
+                    ).start()
+            next_run = min(j["next_run"] for j in self.jobs)
+            self._stop.wait(max(0, next_run - time.monotonic()))
+
+    def stop(self):
+        self._stop.set()
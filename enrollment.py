@@ -0,0 +1,217 @@
+import os
+import logging
+import threading
+from pipeline import O2ZPipeline
+from checkpoint import O2ZCheckpoint
+from metrics import metrics
+
+
+# Enrolls a set of candidate routers (from the OSPF data) into Zabbix as a
+# pipeline of stages: resolve (SNMP system info, through the hostname cache),
+# check (is it already in Zabbix?) and create (host.create). Every stage runs
+# at once, so SNMP timeouts overlap with Zabbix API calls, and a router that
+# fails only takes itself out of the run.
+# Each router's progress goes to an O2ZCheckpoint, so a run that got
+# interrupted can be resumed without asking the routers it already got
+# through again.
+class O2ZEnrollment:
+    def __init__(
+        self,
+        z,
+        omnitik_groupid,
+        omnitik_templateid,
+        host_index,
+        checkpoint=None,
+        refresh_snmp=False,
+        measure="Links",
+    ):
+        self.z = z
+        self.groupid = omnitik_groupid
+        self.templateid = omnitik_templateid
+        self.host_index = host_index
+        self.checkpoint = checkpoint if checkpoint is not None else O2ZCheckpoint()
+        self.refresh_snmp = refresh_snmp
+        # What the candidates' numbers are, for the logs
+        self.measure = measure
+
+        self.snmp_workers = int(os.getenv("P2Z_ENROLL_SNMP_WORKERS", default=2))
+        self.snmp_batch = int(os.getenv("P2Z_ENROLL_SNMP_BATCH", default=64))
+        self.check_batch = int(os.getenv("P2Z_ENROLL_CHECK_BATCH", default=100))
+        self.create_workers = int(os.getenv("P2Z_ENROLL_CREATE_WORKERS", default=2))
+
+        # Names headed for host.create, so two routers claiming the same
+        # sysName don't both get created
+        self.pending_names = set()
+        self.counts = {"enrolled": 0, "exists": 0, "failed": 0, "resumed": 0}
+        # IPs of the routers that failed, at any stage
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def _count(self, status):
+        with self._lock:
+            self.counts[status] += 1
+
+    def _fail(self, ip, **fields):
+        self.checkpoint.record(ip, "failed", **fields)
+        with self._lock:
+            self.counts["failed"] += 1
+            self.failed.add(ip)
+
+    # Run every candidate (a dict of IP -> link count) through the pipeline.
+    # With resume=True, routers the last run already enrolled (or found in
+    # Zabbix) are skipped, the ones it already resolved aren't asked over
+    # SNMP again, and the ones it couldn't resolve are asked again even if
+    # the hostname cache remembers them failing.
+    # Returns the number of routers in each final state.
+    def run(self, candidates, resume=False):
+        records = {}
+        if resume:
+            records = self.checkpoint.load()
+            logging.info(f"Resuming from {len(records)} checkpointed routers")
+            # Otherwise the hostname cache would hand back the same failures
+            self.z.hostname_cache.forget_failures(
+                ip
+                for ip, record in records.items()
+                if record["status"] == "failed" and record.get("stage") == "resolve"
+            )
+        else:
+            self.checkpoint.clear()
+
+        pipeline = O2ZPipeline(on_error=self._on_error)
+        pipeline.add_stage(
+            "resolve",
+            self.resolve,
+            workers=self.snmp_workers,
+            batch_size=self.snmp_batch,
+        )
+        # One worker, so pending_names sees every name in order
+        pipeline.add_stage("check", self.check, batch_size=self.check_batch)
+        pipeline.add_stage(
+            "create",
+            self.create,
+            workers=self.create_workers,
+            batch_size=self.z.zabbix_chunk_size,
+        )
+        try:
+            pipeline.run(self._items(candidates, records))
+        finally:
+            self.checkpoint.close()
+
+        if self.counts["failed"] == 0:
+            self.checkpoint.clear()
+        else:
+            logging.warning(
+                f"{self.counts['failed']} routers failed. "
+                "Run again with --resume to retry only those."
+            )
+        logging.info(
+            f"{self.counts['enrolled']} enrolled, {self.counts['exists']} already "
+            f"in Zabbix, {self.counts['failed']} failed, "
+            f"{self.counts['resumed']} done by a previous run"
+        )
+        return self.counts
+
+    def _items(self, candidates, records):
+        for ip, ct in candidates.items():
+            record = records.get(ip, {})
+            if record.get("status") in ("enrolled", "exists"):
+                self._count("resumed")
+                continue
+            item = {"ip": ip, "ct": ct}
+            # Routers that failed after being resolved keep their info too
+            if "info" in record:
+                item["info"] = record["info"]
+            yield item
+
+    # Stage 1: get the system info of every router that doesn't have it yet
+    def resolve(self, batch):
+        with metrics.timed("enroll_resolve"):
+            need = [item["ip"] for item in batch if "info" not in item]
+            infos = (
+                self.z.resolve_system_info(need, refresh=self.refresh_snmp)
+                if len(need) > 0
+                else {}
+            )
+
+        resolved = []
+        for item in batch:
+            ip = item["ip"]
+            if "info" not in item:
+                info = infos.get(ip)
+                if isinstance(info, Exception) or info is None:
+                    logging.warning(f"Could not get hostname for {ip}. Skipping.")
+                    self._fail(ip, stage="resolve", error=str(info))
+                    continue
+                item["info"] = info
+                self.checkpoint.record(ip, "resolved", info=info)
+            resolved.append(item)
+        return resolved
+
+    # Stage 2: drop the routers Zabbix already has, by name. Nothing is
+    # recorded until the API call has worked, since a failed batch is retried.
+    def check(self, batch):
+        fresh = [
+            item
+            for item in batch
+            if not self.host_index.has_name(item["info"]["sysName"])
+        ]
+        with metrics.timed("enroll_check"):
+            existing = self.z.get_existing_host_names(
+                item["info"]["sysName"] for item in fresh
+            )
+
+        pending = []
+        for item in batch:
+            host_name = item["info"]["sysName"]
+            if (
+                self.host_index.has_name(host_name)
+                or host_name in existing
+                or host_name in self.pending_names
+            ):
+                self._exists(item)
+                continue
+            self.pending_names.add(host_name)
+            template = self.z.snmp_rules.match(item["info"]).template
+            logging.info(
+                f"Host: {host_name}, Router: {item['ip']}, "
+                f"{self.measure}: {item['ct']}, Template: {template}"
+            )
+            pending.append(item)
+        return pending
+
+    def _exists(self, item):
+        logging.warning(
+            f"{item['info']['sysName']} ({item['ip']}) already exists. Skipping."
+        )
+        self.checkpoint.record(item["ip"], "exists")
+        self._count("exists")
+
+    # Stage 3: create the hosts
+    def create(self, batch):
+        with metrics.timed("enroll_create"):
+            results = self.z.create_hosts(
+                [(item["ip"], item["info"]["sysName"], item["info"]) for item in batch],
+                self.groupid,
+                self.templateid,
+                chunk_size=len(batch),
+            )
+
+        created = []
+        for item in batch:
+            host_name = item["info"]["sysName"]
+            hostid = results.get(host_name)
+            if isinstance(hostid, Exception) or hostid is None:
+                self._fail(
+                    item["ip"], stage="create", error=str(hostid), info=item["info"]
+                )
+                continue
+            logging.info(f"{host_name} enrolled as hostid {hostid}")
+            self.checkpoint.record(item["ip"], "enrolled", hostid=hostid)
+            self._count("enrolled")
+            created.append(item)
+        return created
+
+    # A stage raised on a router (the Zabbix API being down, say)
+    def _on_error(self, stage, item, e):
+        fields = {"info": item["info"]} if "info" in item else {}
+        self._fail(item["ip"], stage=stage, error=str(e), **fields)
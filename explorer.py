@@ -1,30 +1,297 @@
 import os
+import gzip
+import json
+import time
+import shutil
+import logging
+import ijson
 import requests
+from prettytable import PrettyTable
+from cache import cache_path
+from metrics import metrics
+from topology import O2ZTopology
 
 
 class O2ZExplorer:
     def __init__(self):
         self.url = os.getenv("P2Z_OSPF_API_URL", default="")
         self.enrolling_link_floor = int(os.getenv("P2Z_LINK_FLOOR", default=10))
+        self.stream = os.getenv("P2Z_OSPF_STREAM", default="1") not in ("", "0")
+        self.stream_chunk_size = int(
+            os.getenv("P2Z_OSPF_STREAM_CHUNK_SIZE", default=64 * 1024)
+        )
+        self.cache_max_age = int(os.getenv("P2Z_OSPF_CACHE_MAX_AGE", default=3600))
+        self.snapshot_path = cache_path("ospf.json.gz")
+        self.meta_path = cache_path("ospf.meta.json")
+        self.routes_path = cache_path("ospf.routes.json")
+        self.state_path = cache_path("ospf.state.json")
 
+        # Set by fetch_ospf_snapshot(). False if the snapshot on disk is the
+        # same one we had last run.
+        self.snapshot_changed = None
+
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip"})
+
+    # Accepts either the parsed OSPF JSON, or an iterable of
+    # (area, router_ip, link_count) tuples like the one parse_ospf_routes()
+    # gives back.
+    # A router in several areas has links in each of them, so its counts
+    # are added up.
     def extract_routes_count(self, data):
+        if isinstance(data, dict):
+            data = self.iter_routes_count(data)
+
         routes_count = {}
+        for area, router_ip, link_ct in data:
+            routes_count[router_ip] = routes_count.get(router_ip, 0) + link_ct
+        return routes_count
 
+    # Walk parsed OSPF JSON, yielding (area, router_ip, link_count)
+    def iter_routes_count(self, data):
+        for area, router_ip, links in self.iter_router_links(data):
+            yield area, router_ip, len(links)
+
+    # Walk parsed OSPF JSON, yielding (area, router_ip, [neighbor_ip...]).
+    # A link without a neighbor ID shows up as None.
+    def iter_router_links(self, data):
         areas = data.get("areas", {})
         for area_key, area_value in areas.items():
             routers = area_value.get("routers", {})
             for router_ip, router_info in routers.items():
-                links = router_info.get("links", {})
-                if links.get("router") == None:
+                links = router_info.get("links", {}).get("router")
+                if links == None:
                     continue
-                link_ct = len(links.get("router"))
-                routes_count[router_ip] = link_ct
-        return routes_count
+                if isinstance(links, dict):
+                    yield area_key, router_ip, list(links.keys())
+                else:
+                    yield area_key, router_ip, [
+                        l.get("id") if isinstance(l, dict) else None for l in links
+                    ]
 
+    @metrics.timed("fetch_ospf")
     def fetch_ospf_json(self):
-        response = requests.get(self.url)
+        response = self.session.get(self.url)
         if response.status_code == 200:
             return response.json()
         else:
             print(f"Failed to fetch data. Status code: {response.status_code}")
             return None
+
+    # Incrementally parse OSPF JSON from a file-like object, yielding
+    # (area, router_ip, link_count)
+    def parse_ospf_routes(self, f):
+        for area, router_ip, links in self.parse_ospf_links(f):
+            yield area, router_ip, len(links)
+
+    # Incrementally parse OSPF JSON from a file-like object, yielding
+    # (area, router_ip, [neighbor_ip...]) like iter_router_links().
+    # The parser's own prefixes join keys with dots, which doesn't work for
+    # keys that are IPs, so keep our own stack of keys instead. The
+    # routers' link lists live at areas.<area>.routers.<ip>.links.router
+    def parse_ospf_links(self, f):
+        stack = []
+        link_depth = None
+        links = []
+        want_id = False
+        for event, value in ijson.basic_parse(f, buf_size=self.stream_chunk_size):
+            if link_depth is not None:
+                depth = len(stack)
+                # Each item directly inside a router's link list is a link.
+                # A map of links is keyed by neighbor ID, and a list of links
+                # holds {"id": neighbor ID, ...} maps.
+                if depth == link_depth:
+                    if link_is_map:
+                        if event == "map_key":
+                            links.append(value)
+                    elif event not in ("end_map", "end_array"):
+                        links.append(None)
+                elif depth == link_depth + 1 and not link_is_map:
+                    if want_id and event in ("string", "number"):
+                        links[-1] = value
+                    want_id = event == "map_key" and value == "id"
+
+            if event == "map_key":
+                stack[-1] = value
+            elif event in ("start_map", "start_array"):
+                if (
+                    len(stack) == 6
+                    and stack[0] == "areas"
+                    and stack[2] == "routers"
+                    and stack[4] == "links"
+                    and stack[5] == "router"
+                ):
+                    link_depth = 7
+                    link_is_map = event == "start_map"
+                    links = []
+                stack.append(None)
+            elif event in ("end_map", "end_array"):
+                stack.pop()
+                if link_depth is not None and len(stack) == link_depth - 1:
+                    link_depth = None
+                    yield stack[1], stack[3], links
+
+    # Get the link count of every router, going through the on-disk cache.
+    # If the snapshot hasn't changed since the last run, the link counts
+    # parsed from it last time are used as-is.
+    # Pass offline=True to replay the cached snapshot without touching the
+    # OSPF Explorer at all.
+    def fetch_ospf_routes(self, offline=False):
+        snapshot = self.fetch_ospf_snapshot(offline)
+        if snapshot is None:
+            return None
+
+        if not self.snapshot_changed and os.path.exists(self.routes_path):
+            logging.info("OSPF data has not changed. Using cached link counts.")
+            with open(self.routes_path) as f:
+                return json.load(f)
+
+        with metrics.timed("parse_ospf"), gzip.open(snapshot, "rb") as f:
+            if self.stream:
+                routes_count = self.extract_routes_count(self.parse_ospf_routes(f))
+            else:
+                routes_count = self.extract_routes_count(json.load(f))
+        metrics.count("ospf_routers", len(routes_count))
+
+        self._write_json(self.routes_path, routes_count)
+        return routes_count
+
+    # Build the router graph from the snapshot we already have on disk
+    @metrics.timed("build_topology")
+    def load_ospf_topology(self):
+        with gzip.open(self.snapshot_path, "rb") as f:
+            if self.stream:
+                topology = O2ZTopology.from_links(self.parse_ospf_links(f))
+            else:
+                topology = O2ZTopology.from_links(self.iter_router_links(json.load(f)))
+        logging.info(
+            f"Mesh has {len(topology)} routers and {topology.link_count()} links"
+        )
+        return topology
+
+    # Make sure the cached OSPF snapshot is up to date, and return its path.
+    # A snapshot younger than P2Z_OSPF_CACHE_MAX_AGE is used without asking.
+    # Otherwise the request is made conditional on the ETag/Last-Modified of
+    # the cached one, and a 304 means we keep what we have.
+    @metrics.timed("fetch_ospf")
+    def fetch_ospf_snapshot(self, offline=False):
+        meta = self._load_meta()
+        have_snapshot = os.path.exists(self.snapshot_path)
+
+        if offline:
+            if not have_snapshot:
+                raise ValueError("No cached OSPF snapshot to replay!")
+            logging.info(f"Replaying cached OSPF snapshot {self.snapshot_path}")
+            self.snapshot_changed = False
+            metrics.cache("ospf_snapshot", hits=1)
+            return self.snapshot_path
+
+        age = time.time() - meta.get("fetched_at", 0)
+        if have_snapshot and age < self.cache_max_age:
+            logging.info(f"Cached OSPF snapshot is {int(age)}s old. Using it.")
+            self.snapshot_changed = False
+            metrics.cache("ospf_snapshot", hits=1)
+            return self.snapshot_path
+
+        headers = {}
+        if have_snapshot:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        with self.session.get(self.url, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                logging.info("OSPF data has not changed since the last fetch.")
+                meta["fetched_at"] = time.time()
+                self._write_json(self.meta_path, meta)
+                self.snapshot_changed = False
+                metrics.cache("ospf_snapshot", hits=1)
+                return self.snapshot_path
+
+            if response.status_code != 200:
+                print(f"Failed to fetch data. Status code: {response.status_code}")
+                return None
+
+            # Recompress the body into the cache as it comes in
+            response.raw.decode_content = True
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with gzip.open(tmp_path, "wb") as f:
+                shutil.copyfileobj(response.raw, f, self.stream_chunk_size)
+            os.replace(tmp_path, self.snapshot_path)
+
+            meta = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+            }
+            self._write_json(self.meta_path, meta)
+            self.snapshot_changed = True
+            metrics.cache("ospf_snapshot", misses=1)
+            return self.snapshot_path
+
+    # The link counts as they were at the end of the last enrollment run
+    def load_previous_routes(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_previous_routes(self, routes_count):
+        self._write_json(self.state_path, routes_count)
+
+    # Compare two sets of link counts against the link floor.
+    # Returns a dict of change -> {router_ip: (old_count, new_count)}, where:
+    #    new: routers we had never seen before that are over the floor
+    #    crossed: routers we knew about that are now over the floor
+    #    dropped: routers that were over the floor and now aren't (or are gone)
+    @staticmethod
+    def diff_routes_count(old, new, link_floor):
+        diff = {"new": {}, "crossed": {}, "dropped": {}}
+        for router_ip, ct in new.items():
+            old_ct = old.get(router_ip)
+            if ct < link_floor:
+                continue
+            if old_ct is None:
+                diff["new"][router_ip] = (None, ct)
+            elif old_ct < link_floor:
+                diff["crossed"][router_ip] = (old_ct, ct)
+
+        for router_ip, old_ct in old.items():
+            if old_ct < link_floor:
+                continue
+            ct = new.get(router_ip)
+            if ct is None or ct < link_floor:
+                diff["dropped"][router_ip] = (old_ct, ct)
+        return diff
+
+    @staticmethod
+    def pretty_print_diff(diff):
+        t = PrettyTable()
+        t.field_names = ["Change", "Router", "Old Links", "New Links"]
+        for change, routers in diff.items():
+            for router_ip, (old_ct, ct) in sorted(routers.items()):
+                t.add_row(
+                    [
+                        change,
+                        router_ip,
+                        "-" if old_ct is None else old_ct,
+                        "-" if ct is None else ct,
+                    ]
+                )
+        return t
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from cache import cache_path
+from metrics import metrics
+
+
+# Persistent IP -> SNMP hostname (and the rest of the system group) cache,
+# since router sysNames almost never change. Routers that didn't answer are
+# remembered too, for a shorter time, so they aren't retried on every run.
+# Safe to share between threads.
+class O2ZHostnameCache:
+    def __init__(self, path=None):
+        if path is None:
+            path = cache_path("hostnames.sqlite")
+        self.ttl = int(os.getenv("P2Z_SNMP_CACHE_TTL", default=7 * 24 * 60 * 60))
+        self.negative_ttl = int(
+            os.getenv("P2Z_SNMP_CACHE_NEGATIVE_TTL", default=6 * 60 * 60)
+        )
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS hostnames (
+                ip TEXT PRIMARY KEY,
+                hostname TEXT,
+                error TEXT,
+                fetched_at REAL NOT NULL
+            )
+            """)
+        # Caches from before we kept the whole system group
+        columns = [r[1] for r in self.conn.execute("PRAGMA table_info(hostnames)")]
+        if "info" not in columns:
+            self.conn.execute("ALTER TABLE hostnames ADD COLUMN info TEXT")
+
+    def close(self):
+        self.conn.close()
+
+    # Returns a dict of IP -> system info, like snmp.snmp_get_system_info()
+    # gives back (or ValueError, for routers that recently failed) for every
+    # IP that has a fresh entry.
+    def get_many(self, ips):
+        ips = list(ips)
+        now = time.time()
+        found = {}
+        for i in range(0, len(ips), 500):
+            chunk = ips[i : i + 500]
+            with self._lock:
+                rows = self.conn.execute(
+                    f"SELECT ip, hostname, error, fetched_at, info FROM hostnames "
+                    f"WHERE ip IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            for ip, hostname, error, fetched_at, info in rows:
+                if hostname is not None and now - fetched_at < self.ttl:
+                    # Entries from before we kept the system group are misses
+                    if info is not None:
+                        found[ip] = json.loads(info)
+                elif hostname is None and now - fetched_at < self.negative_ttl:
+                    found[ip] = ValueError(f"{ip}: {error} (cached)")
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(ips) - len(found)
+        metrics.cache("snmp_hostnames", hits=len(found), misses=len(ips) - len(found))
+        return found
+
+    # Store a dict of IP -> system info, or the exception the lookup failed
+    # with
+    def put_many(self, infos):
+        now = time.time()
+        rows = [
+            (
+                (ip, None, str(info), now, None)
+                if isinstance(info, Exception)
+                else (ip, info["sysName"], None, now, json.dumps(info))
+            )
+            for ip, info in infos.items()
+        ]
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hostnames "
+                "(ip, hostname, error, fetched_at, info) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    # Forget the cached failures of `ips`, so they're asked again
+    def forget_failures(self, ips):
+        ips = list(ips)
+        with self._lock, self.conn:
+            for i in range(0, len(ips), 500):
+                chunk = ips[i : i + 500]
+                self.conn.execute(
+                    f"DELETE FROM hostnames WHERE hostname IS NULL "
+                    f"AND ip IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+
+    def log_stats(self):
+        logging.info(f"SNMP hostname cache: {self.hits} hits, {self.misses} misses")
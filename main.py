@@ -3,12 +3,15 @@ import os
 import logging
 import argparse
 import datetime
+import shlex
 from dotenv import load_dotenv
 import socket
-from triggers import O2ZTriggers
-from bucket import O2ZBucket
-from slack import O2ZSlack
-from zabbix import O2ZZabbix
+from metrics import metrics
+
+# Every subcommand's heavy dependencies (boto3, psycopg2, pysnmp, pyzabbix,
+# slack_sdk...) are imported inside its handler, so that a subcommand only
+# pays for what it actually uses. Keep it that way, or the startup benchmark
+# (benchmarks/startup.py) will complain.
 
 # OSPF2ZABBIX
 # A simple python program designed to fetch data from the NYC Mesh OSPF API,
@@ -27,14 +30,10 @@ def is_valid_ipv4(ip):
         return False
 
 
-def main():
-    print(datetime.datetime.now())
-    load_dotenv()
+def build_parser():
     noisy_days_ago = int(os.getenv("P2Z_NOISY_DAYS_AGO", default=7))
     noisy_leaderboard = int(os.getenv("P2Z_NOISY_LEADERBOARD", default=20))
 
-    logging.basicConfig(level=logging.INFO)
-
     parser = argparse.ArgumentParser(
         description="Automation and management tools for NYCMesh Zabbix"
     )
@@ -52,6 +51,53 @@ def main():
         default=int(os.getenv("P2Z_LINK_FLOOR", default=10)),
         help="Get devices on the mesh and automatically add ones that have a minimum number of links (Defaults to 10).",
     )
+    enroll_parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Replay the cached OSPF snapshot instead of fetching a new one",
+    )
+    enroll_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only check devices that are new or crossed the link floor since the last run",
+    )
+    enroll_parser.add_argument(
+        "--refresh-snmp",
+        action="store_true",
+        help="Ignore cached SNMP hostnames and ask every router again",
+    )
+    enroll_parser.add_argument(
+        "--critical",
+        type=int,
+        nargs="?",
+        const=1,
+        help="Instead of by link count, enroll the routers whose failure would cut off at least this many others from the mesh (Defaults to 1)",
+    )
+    enroll_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Pick up where an interrupted enroll run stopped, instead of starting over",
+    )
+    enroll_parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="Disable hosts that are gone from OSPF, and delete them once they've been gone for the grace period",
+    )
+    enroll_parser.add_argument(
+        "--grace-days",
+        type=float,
+        help="Days a host stays disabled before --reconcile deletes it (Defaults to P2Z_RECONCILE_GRACE_DAYS, or 14)",
+    )
+    enroll_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="With --reconcile, only print what would be disabled, enabled and deleted",
+    )
+    enroll_parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Print how the mesh changed since the last run, without enrolling anything",
+    )
 
     triggers_parser = subparsers.add_parser(
         "noisy-triggers", help="Query the Zabbix DB directly for noisy triggers"
@@ -66,17 +112,43 @@ def main():
         action="store_true",
         help="Prints CSV report of noisy triggers, but DOES NOT publish it",
     )
+    triggers_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Also publish every noisy trigger, not just the leaderboard, as a CSV to S3",
+    )
+    triggers_parser.add_argument(
+        "--flaps",
+        action="store_true",
+        help="Also report how often triggers flap (re-fire soon after recovering) and how long their problems last. With --publish, every noisy trigger's flap stats go to S3 as a CSV",
+    )
     triggers_parser.add_argument(
         "--slack",
         action="store_true",
         help="Publish table of noisy triggers to Slack",
     )
+    triggers_parser.add_argument(
+        "--rollup",
+        action="store_true",
+        default=True if os.getenv("P2Z_TRIGGER_ROLLUP") else False,
+        help="Keep per-day counts in a local rollup store and only query days not counted yet",
+    )
     triggers_parser.add_argument(
         "--days-ago",
         type=int,
         default=noisy_days_ago,
         help="# of days ago to query for triggers",
     )
+    triggers_parser.add_argument(
+        "--windows",
+        type=lambda windows: [int(w) for w in windows.split(",")],
+        help="Comma separated windows in days (e.g. 1,7,30) to report on at once, with the change from each previous window",
+    )
+    triggers_parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Print EXPLAIN (ANALYZE, BUFFERS) output and timings for the noisy triggers query, then exit",
+    )
     triggers_parser.add_argument(
         "--leaderboard",
         type=int,
@@ -93,7 +165,40 @@ def main():
     bucket_parser.add_argument(
         "--delete",
         type=str,
-        help="Delete an S3 object",
+        nargs="+",
+        help="Delete S3 objects (up to 1000 per request)",
+    )
+    bucket_parser.add_argument(
+        "--prefix",
+        type=str,
+        default="",
+        help="Only list objects under this prefix. With --since/--until, a report root like zabbix/csv/",
+    )
+    bucket_parser.add_argument(
+        "--since",
+        type=datetime.date.fromisoformat,
+        help="Only list reports dated on or after this day (YYYY-MM-DD)",
+    )
+    bucket_parser.add_argument(
+        "--until",
+        type=datetime.date.fromisoformat,
+        help="Only list reports dated on or before this day (YYYY-MM-DD)",
+    )
+    bucket_parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Delete dated reports older than --keep-days",
+    )
+    bucket_parser.add_argument(
+        "--keep-days",
+        type=int,
+        default=int(os.getenv("P2Z_S3_KEEP_DAYS", default=365)),
+        help="# of days of reports to keep when pruning (Defaults to 365)",
+    )
+    bucket_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print what --prune or --delete would delete, without deleting it",
     )
 
     slack_parser = subparsers.add_parser("slack", help="Slack helper functions")
@@ -103,62 +208,280 @@ def main():
         help="Deletes a message from the bot",
     )
 
-    args = parser.parse_args()
-    logging.debug(args)
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Stay running, and enroll devices and report noisy triggers on a schedule",
+    )
+    serve_parser.add_argument(
+        "--enroll-interval",
+        type=int,
+        default=int(os.getenv("P2Z_SERVE_ENROLL_INTERVAL", default=24 * 60 * 60)),
+        help="Seconds between enroll runs (0 to disable)",
+    )
+    serve_parser.add_argument(
+        "--enroll-args",
+        type=str,
+        default=os.getenv("P2Z_SERVE_ENROLL_ARGS", default=""),
+        help="Arguments to pass to each enroll run (e.g. --enroll-args=--incremental). Defaults to enrolling popular devices",
+    )
+    serve_parser.add_argument(
+        "--triggers-interval",
+        type=int,
+        default=int(os.getenv("P2Z_SERVE_TRIGGERS_INTERVAL", default=7 * 24 * 60 * 60)),
+        help="Seconds between noisy-triggers runs (0 to disable)",
+    )
+    serve_parser.add_argument(
+        "--triggers-args",
+        type=str,
+        default=os.getenv("P2Z_SERVE_TRIGGERS_ARGS", default="--publish --slack"),
+        help="Arguments to pass to each noisy-triggers run (e.g. --triggers-args='--slack --windows 1,7')",
+    )
+
+    return parser
+
+
+def enroll(z, args):
+    if args.ip:
+        if not is_valid_ipv4(args.ip):
+            raise ValueError("Must pass a valid IPv4 address!")
+        z.enroll_device(args.ip, refresh_snmp=args.refresh_snmp)
+    elif args.reconcile:
+        z.reconcile_hosts(
+            offline=args.offline, grace_days=args.grace_days, dry_run=args.dry_run
+        )
+    elif args.popular or args.critical:
+        z.enroll_popular_devices(
+            args.popular,
+            offline=args.offline,
+            incremental=args.incremental,
+            refresh_snmp=args.refresh_snmp,
+            critical=args.critical,
+            resume=args.resume,
+        )
+
+
+def noisy_triggers(z, t, args):
+    from bucket import O2ZBucket
+    from slack import O2ZSlack
+    from publish import O2ZPublisher
 
-    if args.subcommand in ("enroll", "noisy-triggers"):
-        z = O2ZZabbix()
-        if args.subcommand == "enroll":
-            if args.ip:
-                if not is_valid_ipv4(args.ip):
-                    raise ValueError("Must pass a valid IPv4 address!")
-                z.enroll_device(args.ip)
-            elif args.popular:
-                z.enroll_popular_devices(args.popular)
-            else:
-                args.help()
-
-        elif args.subcommand == "noisy-triggers":
-            logging.info("Checking noisiest triggers...")
-            t = O2ZTriggers()
-
-            t.get_noisiest_triggers(
-                z.get_or_create_hostgroup(), args.days_ago, args.leaderboard
+    logging.info("Checking noisiest triggers...")
+
+    if args.explain:
+        print(
+            t.explain_noisiest_triggers(
+                z.get_or_create_hostgroup(),
+                args.days_ago,
+                args.leaderboard,
+                args.windows,
             )
+        )
+        return
 
-            print(t.pretty_print())
+    if args.windows:
+        t.get_noisiest_triggers_windows(
+            z.get_or_create_hostgroup(), args.windows, args.leaderboard
+        )
+    else:
+        t.get_noisiest_triggers(
+            z.get_or_create_hostgroup(), args.days_ago, args.leaderboard
+        )
 
-            if args.publish or args.test_publish:
-                if not args.test_publish:
-                    logging.info("Publishing noise reports to S3...")
-                s3 = O2ZBucket()
-                pretty_publish = True if os.getenv("P2Z_S3_PRETTY") else False
-                s3.publish_noise_reports(
-                    t, pretty=pretty_publish, test=args.test_publish
-                )
+    if args.flaps:
+        t.get_flappiest_triggers(
+            z.get_or_create_hostgroup(), args.days_ago, args.leaderboard
+        )
 
-            if args.slack:
-                logging.info("Publishing noise reports to slack...")
-                slack = O2ZSlack()
-                slack.publish_noise_reports(t.trigger_list)
+    # Send the report everywhere it needs to go at once. Except with
+    # --test-publish, where every sink prints to stdout, and running them at
+    # once would interleave their rows.
+    publisher = O2ZPublisher(sequential=args.test_publish)
+    if args.windows:
+        publisher.add_sink("stdout", lambda: print(t.pretty_print_windows()))
+    else:
+        publisher.add_sink("stdout", lambda: print(t.pretty_print()))
+    if args.flaps:
+        publisher.add_sink("stdout-flaps", lambda: print(t.pretty_print_flaps()))
 
-    elif args.subcommand == "bucket":
-        s3 = O2ZBucket()
+    if args.publish or args.test_publish:
+        if not args.test_publish:
+            logging.info("Publishing noise reports to S3...")
+        pretty_publish = True if os.getenv("P2Z_S3_PRETTY") else False
+        # boto3's default session isn't thread-safe, so build the client here,
+        # once. The client itself is safe to share between the sinks.
+        bucket = O2ZBucket()
+        publisher.add_sink(
+            "s3",
+            lambda: bucket.publish_noise_reports(
+                t, pretty=pretty_publish, test=args.test_publish
+            ),
+        )
+        # The full dumps aren't capped by the leaderboard, so they get longer
+        # to finish. One that still doesn't gets its upload aborted, rather
+        # than left half-done in the bucket.
+        dump_timeout = float(os.getenv("P2Z_PUBLISH_DUMP_TIMEOUT", default=3600))
+        if args.full:
+            group_id = z.get_or_create_hostgroup()
+            full_uploads = []
+            publisher.add_sink(
+                "s3-full",
+                lambda: bucket.publish_full_noise_report(
+                    t.iter_noisiest_triggers(group_id, args.days_ago),
+                    test=args.test_publish,
+                    uploads=full_uploads,
+                ),
+                timeout=dump_timeout,
+                on_timeout=lambda: bucket.abort_uploads(full_uploads),
+            )
+        if args.flaps:
+            group_id = z.get_or_create_hostgroup()
+            flap_uploads = []
+            publisher.add_sink(
+                "s3-flaps",
+                lambda: bucket.publish_flap_report(
+                    t.iter_flapping_triggers(group_id, args.days_ago),
+                    test=args.test_publish,
+                    uploads=flap_uploads,
+                ),
+                timeout=dump_timeout,
+                on_timeout=lambda: bucket.abort_uploads(flap_uploads),
+            )
+
+    if args.slack:
+        logging.info("Publishing noise reports to slack...")
+        if args.windows:
+            publisher.add_sink(
+                "slack", lambda: O2ZSlack().publish_noise_windows(t.windows)
+            )
+        else:
+            publisher.add_sink(
+                "slack",
+                lambda: O2ZSlack().publish_noise_reports(t.trigger_list, args.days_ago),
+            )
+
+    return publisher.publish()
+
+
+# Keep one Zabbix session, one DB connection and their caches around, and run
+# enroll and noisy-triggers on their own intervals
+def serve(parser, args):
+    from daemon import O2ZDaemon
+
+    enroll_args = parser.parse_args(["enroll", *shlex.split(args.enroll_args)])
+    triggers_args = parser.parse_args(
+        ["noisy-triggers", *shlex.split(args.triggers_args)]
+    )
+
+    daemon = O2ZDaemon()
+    daemon.add_job(
+        "enroll",
+        args.enroll_interval,
+        lambda: enroll(daemon.zabbix("enroll"), enroll_args),
+    )
+    daemon.add_job(
+        "noisy-triggers",
+        args.triggers_interval,
+        lambda: noisy_triggers(
+            daemon.zabbix("noisy-triggers"),
+            daemon.triggers("noisy-triggers", triggers_args.rollup),
+            triggers_args,
+        ),
+    )
+    daemon.run()
 
-        if args.object:
-            s3.print_objects(args.object)
-            return
 
-        if args.delete:
-            s3.delete_object(args.delete)
+def main():
+    print(datetime.datetime.now())
+    load_dotenv()
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = build_parser()
+    args = parser.parse_args()
+    logging.debug(args)
+
+    run = SUBCOMMANDS[args.subcommand]
+    # The daemon reports on each of its jobs instead
+    if args.subcommand == "serve":
+        run(parser, args)
+        return
+
+    try:
+        with metrics.run(args.subcommand):
+            run(parser, args)
+    finally:
+        metrics.export()
+
+
+def run_enroll(parser, args):
+    if args.diff:
+        from explorer import O2ZExplorer
+
+        e = O2ZExplorer()
+        route_dict = e.fetch_ospf_routes(args.offline)
+        if route_dict is None:
             return
+        diff = e.diff_routes_count(e.load_previous_routes(), route_dict, args.popular)
+        print(e.pretty_print_diff(diff))
+        return
+
+    if not args.ip and not args.popular and not args.critical and not args.reconcile:
+        parser.print_help()
+        return
+
+    from zabbix import O2ZZabbix
+
+    enroll(O2ZZabbix(), args)
+
+
+def run_noisy_triggers(parser, args):
+    from zabbix import O2ZZabbix
+    from triggers import O2ZTriggers
+    from publish import O2ZPublisher
+
+    results = noisy_triggers(O2ZZabbix(), O2ZTriggers(rollup=args.rollup), args)
+
+    # Each failure has been logged already. Just make sure we don't exit 0.
+    failed = O2ZPublisher.failures(results or {})
+    if len(failed) > 0:
+        raise SystemExit(f"Could not publish to {', '.join(failed)}")
+
+
+def run_bucket(parser, args):
+    from bucket import O2ZBucket
+
+    s3 = O2ZBucket()
+
+    if args.object:
+        s3.print_objects(args.object)
+        return
+
+    if args.delete:
+        s3.delete_keys(args.delete, dry_run=args.dry_run)
+        return
+
+    if args.prune:
+        s3.prune(args.keep_days, dry_run=args.dry_run)
+        return
+
+    s3.list_objects(args.prefix, args.since, args.until)
+
+
+def run_slack(parser, args):
+    from slack import O2ZSlack
+
+    slack = O2ZSlack()
+    if args.delete:
+        slack.delete_report(args.delete)
 
-        s3.list_objects()
 
-    elif args.subcommand == "slack":
-        slack = O2ZSlack()
-        if args.delete:
-            slack.delete_report(args.delete)
+SUBCOMMANDS = {
+    "enroll": run_enroll,
+    "noisy-triggers": run_noisy_triggers,
+    "bucket": run_bucket,
+    "slack": run_slack,
+    "serve": serve,
+}
 
 
 if __name__ == "__main__":
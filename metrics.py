@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import socket
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# zabbix_sender protocol header: "ZBXD", flags (0x01 = plain JSON), then the
+# length of the JSON payload as a little-endian 64 bit int
+ZABBIX_SENDER_HEADER = b"ZBXD\x01"
+
+
+# Process-wide timings, counts, errors and cache hits for each phase of a run
+# (fetching OSPF data, SNMP, Zabbix API calls, trigger queries, publishing...).
+# Written out at the end of the run as a Prometheus node-exporter textfile
+# and/or pushed to Zabbix trapper items, so o2z can be monitored by the
+# Zabbix it manages.
+# For a one-off run the numbers cover that run. Under `serve` they add up
+# from when the daemon started, like any other Prometheus counter.
+class O2ZMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # phase -> {"seconds", "calls", "errors"}
+            self.phases = {}
+            # name -> count
+            self.items = {}
+            # cache -> {"hits", "misses"}
+            self.caches = {}
+            # subcommand/job -> {"seconds", "success", "timestamp"}
+            self.runs = {}
+
+    # Time a phase. Works as a context manager or a decorator. A phase that
+    # raises is counted as an error, and the exception passed along.
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(phase, time.perf_counter() - start, error)
+
+    def observe(self, phase, seconds, error=False):
+        with self._lock:
+            p = self.phases.setdefault(phase, {"seconds": 0.0, "calls": 0, "errors": 0})
+            p["seconds"] += seconds
+            p["calls"] += 1
+            p["errors"] += int(error)
+
+    # Count things a phase went through (routers, hosts enrolled, rows...)
+    def count(self, name, n=1):
+        with self._lock:
+            self.items[name] = self.items.get(name, 0) + n
+
+    def error(self, phase, n=1):
+        with self._lock:
+            p = self.phases.setdefault(phase, {"seconds": 0.0, "calls": 0, "errors": 0})
+            p["errors"] += n
+
+    def cache(self, name, hits=0, misses=0):
+        with self._lock:
+            c = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+            c["hits"] += hits
+            c["misses"] += misses
+
+    # Time a whole subcommand (or daemon job), and remember whether it worked
+    @contextmanager
+    def run(self, name):
+        start = time.perf_counter()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            with self._lock:
+                self.runs[name] = {
+                    "seconds": time.perf_counter() - start,
+                    "success": int(success),
+                    "timestamp": int(time.time()),
+                }
+
+    # Write out / push everything, as configured in the environment. Never
+    # raises, since failing to report metrics shouldn't fail the run.
+    def export(self):
+        textfile = os.getenv("P2Z_METRICS_TEXTFILE")
+        if textfile:
+            try:
+                self.write_textfile(textfile)
+            except OSError as e:
+                logging.error(f"Could not write metrics to {textfile}: {e}")
+
+        zabbix_host = os.getenv("P2Z_METRICS_ZABBIX_HOST")
+        if zabbix_host:
+            server = (
+                os.getenv("P2Z_METRICS_ZABBIX_SERVER")
+                or urlparse(os.getenv("P2Z_ZABBIX_URL", default="")).hostname
+            )
+            port = int(os.getenv("P2Z_METRICS_ZABBIX_PORT", default=10051))
+            try:
+                self.push_zabbix(server, port, zabbix_host)
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not push metrics to Zabbix at {server}: {e}")
+
+    # (name, labels, value) for every metric
+    def _samples(self):
+        with self._lock:
+            samples = []
+            for phase, p in sorted(self.phases.items()):
+                labels = {"phase": phase}
+                samples += [
+                    ("o2z_phase_seconds_total", labels, p["seconds"]),
+                    ("o2z_phase_calls_total", labels, p["calls"]),
+                    ("o2z_phase_errors_total", labels, p["errors"]),
+                ]
+            for name, n in sorted(self.items.items()):
+                samples.append(("o2z_items_total", {"name": name}, n))
+            for name, c in sorted(self.caches.items()):
+                labels = {"cache": name}
+                samples += [
+                    ("o2z_cache_hits_total", labels, c["hits"]),
+                    ("o2z_cache_misses_total", labels, c["misses"]),
+                ]
+            for name, r in sorted(self.runs.items()):
+                labels = {"run": name}
+                samples += [
+                    ("o2z_run_seconds", labels, r["seconds"]),
+                    ("o2z_run_success", labels, r["success"]),
+                    ("o2z_run_timestamp_seconds", labels, r["timestamp"]),
+                ]
+            return samples
+
+    # Every sample of a metric has to come together, right after its TYPE
+    def prometheus_text(self):
+        families = {}
+        for name, labels, value in self._samples():
+            families.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, samples in families.items():
+            kind = "counter" if name.endswith("_total") else "gauge"
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_str = ",".join(
+                    f'{k}="{_escape_label(v)}"' for k, v in labels.items()
+                )
+                lines.append(f"{name}{{{label_str}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    # Write the node-exporter textfile collector file. Written to a temporary
+    # file and renamed into place, so the collector never reads half of it.
+    def write_textfile(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+        logging.info(f"Wrote metrics to {path}")
+
+    # Send every metric to trapper items on `host` in one zabbix_sender
+    # request. Item keys look like o2z.phase.seconds[snmp_get], and need to
+    # exist on the host as "Zabbix trapper" items.
+    def push_zabbix(self, server, port, host, timeout=10):
+        if not server:
+            raise ValueError("No Zabbix server to push metrics to")
+        clock = int(time.time())
+        data = [
+            {
+                "host": host,
+                "key": _zabbix_key(name, labels),
+                "value": str(value),
+                "clock": clock,
+            }
+            for name, labels, value in self._samples()
+        ]
+        payload = json.dumps({"request": "sender data", "data": data}).encode()
+
+        with socket.create_connection((server, port), timeout=timeout) as s:
+            s.sendall(ZABBIX_SENDER_HEADER + struct.pack("<Q", len(payload)) + payload)
+            header = _recv_exactly(s, len(ZABBIX_SENDER_HEADER) + 8)
+            if not header.startswith(ZABBIX_SENDER_HEADER[:4]):
+                raise ValueError(f"Bad response from Zabbix: {header!r}")
+            (length,) = struct.unpack("<Q", header[len(ZABBIX_SENDER_HEADER) :])
+            response = json.loads(_recv_exactly(s, length))
+
+        if response.get("response") != "success":
+            raise ValueError(f"Zabbix rejected metrics: {response}")
+        logging.info(f"Pushed metrics to Zabbix: {response.get('info')}")
+        return response
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# o2z_phase_seconds_total{phase="snmp_get"} -> o2z.phase.seconds[snmp_get]
+def _zabbix_key(name, labels):
+    key = name.removesuffix("_total").replace("_", ".", 2)
+    if labels:
+        key += f"[{','.join(str(v) for v in labels.values())}]"
+    return key
+
+
+def _recv_exactly(s, n):
+    data = b""
+    while len(data) < n:
+        chunk = s.recv(n - len(data))
+        if not chunk:
+            raise ValueError("Zabbix closed the connection early")
+        data += chunk
+    return data
+
+
+metrics = O2ZMetrics()
@@ -0,0 +1,124 @@
+import os
+import queue
+import logging
+import threading
+
+# Tells a stage's workers there's nothing more coming
+_DONE = object()
+
+
+# A chain of stages connected by bounded queues, each stage with its own pool
+# of worker threads, so every stage works at once and throughput is set by
+# the slowest one instead of by the sum of them. A full queue blocks the
+# stage feeding it (backpressure), so a slow stage can't pile up work in
+# memory.
+# A stage is a function that takes a list of items and returns (or yields)
+# the items to hand to the next stage. Workers take whatever's waiting in
+# their queue, up to batch_size items at once, so batches grow when a stage
+# falls behind. If a stage fails on a batch, the items are retried one by one,
+# and only the ones that still fail are dropped, with on_error(stage, item,
+# exception) called for each. What the last stage returns ends up in
+# `results`.
+class O2ZPipeline:
+    def __init__(self, queue_size=None, on_error=None):
+        if queue_size is None:
+            queue_size = int(os.getenv("P2Z_PIPELINE_QUEUE_SIZE", default=256))
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.stages = []
+        self.results = []
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, fn, workers=1, batch_size=1):
+        self.stages.append(
+            {
+                "name": name,
+                "fn": fn,
+                "workers": workers,
+                "batch_size": batch_size,
+                "queue": queue.Queue(maxsize=self.queue_size),
+                "threads": [],
+            }
+        )
+
+    # Push `items` through every stage, and wait for them all to come out
+    def run(self, items):
+        for i, stage in enumerate(self.stages):
+            out = self.stages[i + 1]["queue"] if i + 1 < len(self.stages) else None
+            for n in range(stage["workers"]):
+                t = threading.Thread(
+                    target=self._work,
+                    args=(stage, out),
+                    name=f"o2z-{stage['name']}-{n}",
+                    daemon=True,
+                )
+                t.start()
+                stage["threads"].append(t)
+
+        first = self.stages[0]["queue"]
+        for item in items:
+            first.put(item)
+
+        # Close each stage once the one before it has finished
+        for i, stage in enumerate(self.stages):
+            for _ in stage["threads"]:
+                stage["queue"].put(_DONE)
+            for t in stage["threads"]:
+                t.join()
+        return self.results
+
+    def _work(self, stage, out):
+        done = False
+        while not done:
+            batch = [stage["queue"].get()]
+            if batch[0] is _DONE:
+                return
+            while len(batch) < stage["batch_size"]:
+                try:
+                    item = stage["queue"].get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+
+            for item in self._process(stage, batch):
+                if out is not None:
+                    out.put(item)
+                else:
+                    with self._lock:
+                        self.results.append(item)
+
+    def _process(self, stage, batch):
+        try:
+            return list(stage["fn"](batch))
+        except Exception as e:
+            if len(batch) == 1:
+                self._fail(stage, batch[0], e)
+                return []
+            logging.warning(
+                f"{stage['name']} failed on {len(batch)} items ({e}). "
+                "Retrying them one by one."
+            )
+
+        results = []
+        for item in batch:
+            try:
+                results.extend(stage["fn"]([item]))
+            except Exception as e:
+                self._fail(stage, item, e)
+        return results
+
+    def _fail(self, stage, item, e):
+        logging.error(f"{stage['name']} failed on {item}: {e}")
+        with self._lock:
+            self.failed.append((stage["name"], item, e))
+        if self.on_error is not None:
+            # A worker that dies here would leave the stage before it blocked
+            # on a full queue forever
+            try:
+                self.on_error(stage["name"], item, e)
+            except Exception as err:
+                logging.error(f"on_error failed for {stage['name']} on {item}: {err}")
@@ -0,0 +1,83 @@
+import os
+import time
+import logging
+import threading
+from metrics import metrics
+
+
+# Runs every report sink (S3, Slack, stdout...) at the same time, each on its
+# own thread, so a slow or broken sink can't hold up or break the others.
+# Each sink is a function that takes no arguments and publishes an
+# already-computed report.
+# With sequential=True, each sink runs only once the one before it is done,
+# for sinks that all write to the same stream (like --test-publish, where
+# they all go to stdout).
+class O2ZPublisher:
+    def __init__(self, timeout=None, sequential=False):
+        if timeout is None:
+            timeout = float(os.getenv("P2Z_PUBLISH_TIMEOUT", default=60))
+        self.timeout = timeout
+        self.sequential = sequential
+        self.sinks = []
+
+    # `on_timeout`, if given, is called (from the publishing thread) when the
+    # sink runs past its timeout, to clean up after it
+    def add_sink(self, name, publish, timeout=None, on_timeout=None):
+        self.sinks.append(
+            (name, publish, self.timeout if timeout is None else timeout, on_timeout)
+        )
+
+    # Publish to every sink. Returns a dict of sink name -> None if it
+    # succeeded, or the exception it failed with. A sink that runs past its
+    # timeout is reported as failed with a TimeoutError, and left to finish
+    # in the background.
+    # Sinks run on daemon threads rather than a thread pool, since the
+    # interpreter waits for a pool's threads at exit, and a sink that's hung
+    # shouldn't keep o2z running.
+    def publish(self):
+        results = {}
+        if len(self.sinks) == 0:
+            return results
+
+        start = time.monotonic()
+        running = []
+        for name, publish, timeout, on_timeout in self.sinks:
+            outcome = {}
+            thread = threading.Thread(
+                target=self._run_sink,
+                args=(metrics.timed(f"publish_{name}")(publish), outcome),
+                name=f"o2z-publish-{name}",
+                daemon=True,
+            )
+            thread.start()
+            if self.sequential:
+                thread.join(timeout)
+            running.append((name, thread, timeout, on_timeout, outcome))
+
+        for name, thread, timeout, on_timeout, outcome in running:
+            if not self.sequential:
+                thread.join(max(0, start + timeout - time.monotonic()))
+            if thread.is_alive():
+                logging.error(f"Timed out publishing to {name} after {timeout}s")
+                results[name] = TimeoutError(f"{name} timed out after {timeout}s")
+                if on_timeout is not None:
+                    on_timeout()
+            elif "error" in outcome:
+                logging.error(f"Could not publish to {name}: {outcome['error']}")
+                results[name] = outcome["error"]
+            else:
+                results[name] = None
+                logging.info(f"Published to {name}")
+        return results
+
+    @staticmethod
+    def _run_sink(publish, outcome):
+        try:
+            publish()
+        except Exception as e:
+            outcome["error"] = e
+
+    # The sinks that failed, from what publish() returned
+    @staticmethod
+    def failures(results):
+        return [name for name, error in results.items() if error is not None]
@@ -0,0 +1,174 @@
+import os
+import time
+import logging
+from datetime import datetime, timezone
+from prettytable import PrettyTable
+from metrics import metrics
+
+# Tag we put on the hosts we disable, with when we disabled them, so we know
+# when their grace period is up (and which disabled hosts are ours to touch)
+DISABLED_TAG = "o2z.disabled"
+
+# Zabbix host statuses
+HOST_MONITORED = "0"
+HOST_UNMONITORED = "1"
+
+
+# Keeps the host group in line with the routers OSPF can still see. Hosts
+# whose IPs have all disappeared from OSPF are disabled (and tagged with when
+# that happened), and deleted once they've been gone for the grace period.
+# Hosts we disabled that show up again are enabled. Hosts someone disabled
+# by hand, and hosts without an IP, are left alone.
+class O2ZReconciler:
+    def __init__(self, z, grace_days=None, max_stale=None):
+        if grace_days is None:
+            grace_days = float(os.getenv("P2Z_RECONCILE_GRACE_DAYS", default=14))
+        if max_stale is None:
+            max_stale = float(os.getenv("P2Z_RECONCILE_MAX_STALE", default=0.25))
+        self.z = z
+        self.grace_days = grace_days
+        # Refuse to disable more than this fraction of the group at once,
+        # since that's more likely a broken OSPF feed than a dead mesh
+        self.max_stale = max_stale
+
+    # Work out what to do with every host in the group, given the set of
+    # router IPs in OSPF. Returns a dict of action -> [host...], where:
+    #    disable: monitored hosts with none of their IPs in OSPF
+    #    delete: hosts we disabled more than grace_days ago, still gone
+    #    enable: hosts we disabled that are back in OSPF
+    # and each host is the host.get object, plus "disabled_at" (a timestamp)
+    # for the ones we disabled.
+    def plan(self, hosts, routers, now=None):
+        if now is None:
+            now = time.time()
+        grace = self.grace_days * 24 * 60 * 60
+        routers = set(routers)
+        actions = {"disable": [], "delete": [], "enable": []}
+        for h in hosts:
+            ips = {i["ip"] for i in h.get("interfaces", []) if i.get("ip")}
+            if len(ips) == 0:
+                continue
+            disabled_at = _disabled_at(h)
+            gone = ips.isdisjoint(routers)
+
+            if disabled_at is None:
+                if gone and h.get("status") == HOST_MONITORED:
+                    actions["disable"].append(h)
+                continue
+
+            h = {**h, "disabled_at": disabled_at}
+            if not gone:
+                actions["enable"].append(h)
+            elif now - disabled_at >= grace:
+                actions["delete"].append(h)
+        return actions
+
+    @staticmethod
+    def pretty_print_plan(actions):
+        t = PrettyTable()
+        t.field_names = ["Action", "Host", "Host ID", "IPs", "Disabled Since"]
+        for action, hosts in actions.items():
+            for h in sorted(hosts, key=lambda h: h["host"]):
+                disabled_at = h.get("disabled_at")
+                t.add_row(
+                    [
+                        action,
+                        h["host"],
+                        h["hostid"],
+                        ", ".join(i["ip"] for i in h.get("interfaces", [])),
+                        "-" if disabled_at is None else _timestamp(disabled_at),
+                    ]
+                )
+        return t
+
+    # Print the plan, then (unless dry_run) carry it out, chunk_size hosts
+    # per API call. Returns the plan.
+    @metrics.timed("zabbix_reconcile")
+    def reconcile(self, routers, dry_run=False, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = self.z.zabbix_chunk_size
+        if len(routers) == 0:
+            raise ValueError("OSPF has no routers. Refusing to reconcile against it.")
+
+        groupid = self.z.get_or_create_hostgroup()
+        hosts = self.z.get_group_hosts(
+            groupid,
+            output=["hostid", "host", "status"],
+            selectInterfaces=["ip"],
+            selectTags="extend",
+        )
+        actions = self.plan(hosts, routers)
+        print(self.pretty_print_plan(actions))
+        logging.info(
+            f"{len(hosts)} hosts, {len(routers)} routers in OSPF: "
+            + ", ".join(f"{len(h)} to {action}" for action, h in actions.items())
+        )
+
+        if len(actions["disable"]) > self.max_stale * len(hosts):
+            refusal = (
+                f"Refusing to disable {len(actions['disable'])} of {len(hosts)} "
+                f"hosts (over P2Z_RECONCILE_MAX_STALE={self.max_stale})"
+            )
+            if not dry_run:
+                raise ValueError(refusal)
+            logging.warning(f"{refusal}. A real run would stop here.")
+        if dry_run:
+            return actions
+
+        now = _timestamp(time.time())
+        disable = [
+            {
+                "hostid": h["hostid"],
+                "status": HOST_UNMONITORED,
+                "tags": _other_tags(h) + [{"tag": DISABLED_TAG, "value": now}],
+            }
+            for h in actions["disable"]
+        ]
+        enable = [
+            {"hostid": h["hostid"], "status": HOST_MONITORED, "tags": _other_tags(h)}
+            for h in actions["enable"]
+        ]
+        for i in range(0, len(disable), chunk_size):
+            self.z.zapi.host.update(*disable[i : i + chunk_size])
+        for i in range(0, len(enable), chunk_size):
+            self.z.zapi.host.update(*enable[i : i + chunk_size])
+        delete = [h["hostid"] for h in actions["delete"]]
+        for i in range(0, len(delete), chunk_size):
+            self.z.zapi.host.delete(*delete[i : i + chunk_size])
+
+        metrics.count("hosts_disabled", len(disable))
+        metrics.count("hosts_enabled", len(enable))
+        metrics.count("hosts_deleted", len(delete))
+        return actions
+
+
+def _timestamp(t):
+    return (
+        datetime.fromtimestamp(t, timezone.utc)
+        .isoformat(timespec="seconds")
+        .replace("+00:00", "Z")
+    )
+
+
+# When we disabled a host, from its tag, or None if we didn't
+def _disabled_at(host):
+    for tag in host.get("tags", []):
+        if tag.get("tag") == DISABLED_TAG:
+            try:
+                return datetime.fromisoformat(
+                    tag.get("value", "").replace("Z", "+00:00")
+                ).timestamp()
+            except ValueError:
+                # Someone else's idea of a timestamp. We can't tell how long
+                # it's been gone, so it never gets old enough to delete.
+                return time.time()
+    return None
+
+
+# host.update replaces all of a host's tags, so keep everyone else's
+def _other_tags(host):
+    return [
+        {"tag": t["tag"], "value": t.get("value", "")}
+        for t in host.get("tags", [])
+        if t.get("tag") != DISABLED_TAG
+    ]
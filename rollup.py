@@ -0,0 +1,98 @@
+import os
+import time
+import sqlite3
+import threading
+from cache import cache_path
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+# Start of the UTC day that `timestamp` falls in
+def day_start(timestamp):
+    return int(timestamp // SECONDS_PER_DAY) * SECONDS_PER_DAY
+
+
+# Local SQLite store of per-day trigger event counts, so that only the days
+# we haven't seen yet need to be counted in the Zabbix DB.
+# Safe to share between threads.
+class O2ZTriggerRollup:
+    def __init__(self, path=None):
+        if path is None:
+            path = os.getenv("P2Z_TRIGGER_ROLLUP_PATH", default="")
+        if path == "":
+            path = cache_path("trigger_rollup.sqlite")
+        self.retention_days = int(os.getenv("P2Z_TRIGGER_ROLLUP_DAYS", default=90))
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS trigger_rollup (
+                group_id INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                host TEXT NOT NULL,
+                description TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (group_id, day, host, description, priority)
+            );
+            CREATE TABLE IF NOT EXISTS rollup_days (
+                group_id INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                PRIMARY KEY (group_id, day)
+            );
+            """)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    # Complete days in [start, end) that have not been rolled up yet
+    def missing_days(self, group_id, start, end):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT day FROM rollup_days WHERE group_id = ? AND day >= ? AND day < ?",
+                (group_id, start, end),
+            ).fetchall()
+        covered = {r[0] for r in rows}
+        return [day for day in range(start, end, SECONDS_PER_DAY) if day not in covered]
+
+    # Store (day, host, description, priority, count) rows, and mark `days`
+    # as covered, even the ones that had no events.
+    def store(self, group_id, days, rows):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM trigger_rollup WHERE group_id = ? AND day = ?",
+                [(group_id, day) for day in days],
+            )
+            self.conn.executemany(
+                "INSERT INTO trigger_rollup VALUES (?, ?, ?, ?, ?, ?)",
+                [(group_id, *r) for r in rows if r[0] in days],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO rollup_days VALUES (?, ?)",
+                [(group_id, day) for day in days],
+            )
+
+    # Summed counts over [start, end), as {(host, description, priority): count}
+    def counts(self, group_id, start, end):
+        with self._lock:
+            rows = self.conn.execute(
+                """
+                SELECT host, description, priority, SUM(count)
+                FROM trigger_rollup
+                WHERE group_id = ? AND day >= ? AND day < ?
+                GROUP BY host, description, priority
+                """,
+                (group_id, start, end),
+            ).fetchall()
+        return {(r[0], r[1], r[2]): r[3] for r in rows}
+
+    # Throw away days older than the retention period, but never any day
+    # from `keep_from` on
+    def prune(self, keep_from=None):
+        cutoff = day_start(time.time()) - self.retention_days * SECONDS_PER_DAY
+        if keep_from is not None:
+            cutoff = min(cutoff, keep_from)
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM trigger_rollup WHERE day < ?", (cutoff,))
+            self.conn.execute("DELETE FROM rollup_days WHERE day < ?", (cutoff,))
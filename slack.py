@@ -11,8 +11,8 @@ class O2ZSlack:
         assert slack_token is not None
         self.client = WebClient(token=slack_token)
 
-    def publish_noise_reports(self, noisiest_triggers):
-        noisy_trigger_report = f"*Noisiest triggers from the last 7 days*\n"
+    def publish_noise_reports(self, noisiest_triggers, days_ago=7):
+        noisy_trigger_report = f"*Noisiest triggers from the last {days_ago} days*\n"
 
         for t in noisiest_triggers:
             noisy_trigger_report += (
@@ -26,6 +26,22 @@ class O2ZSlack:
         )
         logging.info("Report published to slack")
 
+    # Publish the leaderboard of each window in one message, with how much
+    # each trigger's count changed from the window before it
+    def publish_noise_windows(self, windows):
+        noisy_trigger_report = ""
+        for w, noisiest_triggers in windows.items():
+            noisy_trigger_report += f"*Noisiest triggers from the last {w} days*\n"
+            for t in noisiest_triggers:
+                noisy_trigger_report += f":loud_sound:*×{t.count} ({t.delta:+}) — {t.host}*\n{t.description}\n\n"
+
+        self.client.chat_postMessage(
+            channel=self.channel,
+            text=noisy_trigger_report,
+            mrkdwn=True,
+        )
+        logging.info("Report published to slack")
+
     def delete_report(self, url):
         # https://nycmesh.slack.com/archives/C05TPHA43PD/p1696054569736259
         us = url.split("/")
@@ -1,41 +1,195 @@
+import asyncio
 import logging
-from pysnmp.hlapi import *
-
-
-def snmp_get(host, oid):
-    for errorIndication, errorStatus, errorIndex, varBinds in getCmd(
-        SnmpEngine(),
-        CommunityData("public", mpModel=0),
-        UdpTransportTarget((host, 161)),
-        ContextData(),
-        ObjectType(ObjectIdentity(oid)),
-        lookupMib=False,
-        lexicographicMode=False,
-    ):
-        if errorIndication:
-            logging.error(errorIndication)
-            break
-
-        elif errorStatus:
-            logging.error(
-                "%s at %s"
-                % (
-                    errorStatus.prettyPrint(),
-                    errorIndex and varBinds[int(errorIndex) - 1][0] or "?",
-                )
+from metrics import metrics
+
+SNMP_HOSTNAME_OID = "1.3.6.1.2.1.1.5.0"
+
+# The MIB-II system group, everything we want to know about a router
+SNMP_SYSTEM_OIDS = {
+    "sysName": SNMP_HOSTNAME_OID,
+    "sysDescr": "1.3.6.1.2.1.1.1.0",
+    "sysObjectID": "1.3.6.1.2.1.1.2.0",
+    "sysLocation": "1.3.6.1.2.1.1.6.0",
+}
+
+
+# The asyncio high-level API moved around between pysnmp releases, so find
+# whichever one is installed. Imported lazily, so that importing this module
+# doesn't need the asyncio layer to import.
+# We only ever speak SNMPv1/v2c, so prefer the lightweight v1arch API: the
+# full SnmpEngine configures a MIB-backed target table for every new router,
+# which costs around 10ms of CPU per router and gets slower as it grows.
+def _snmp_asyncio():
+    try:
+        from pysnmp.hlapi.v1arch import asyncio as snmp_asyncio
+    except ImportError:
+        try:
+            from pysnmp.hlapi.v3arch import asyncio as snmp_asyncio
+        except ImportError:
+            from pysnmp.hlapi import asyncio as snmp_asyncio
+    return snmp_asyncio
+
+
+def _snmp_dispatcher(snmp_asyncio):
+    if hasattr(snmp_asyncio, "SnmpDispatcher"):
+        return snmp_asyncio.SnmpDispatcher()
+    return snmp_asyncio.SnmpEngine()
+
+
+def _close_dispatcher(dispatcher):
+    if hasattr(dispatcher, "close"):
+        dispatcher.close()
+    elif hasattr(dispatcher, "close_dispatcher"):
+        dispatcher.close_dispatcher()
+    else:
+        dispatcher.transportDispatcher.closeDispatcher()
+
+
+async def _udp_target(snmp_asyncio, host, port, timeout, retries):
+    target = snmp_asyncio.UdpTransportTarget
+    if hasattr(target, "create"):
+        return await target.create((host, port), timeout=timeout, retries=retries)
+    return target((host, port), timeout=timeout, retries=retries)
+
+
+# An error about one of the OIDs in a GET. `index` is which one (from 1),
+# or 0 if the agent didn't say.
+class SnmpVarBindError(ValueError):
+    def __init__(self, message, index):
+        super().__init__(message)
+        self.index = index
+
+
+# An SNMP GET, for any number of OIDs in one GET PDU.
+# Shares one dispatcher between every request, and bounds the number of
+# requests in flight with the semaphore. Returns the varBinds, in the same
+# order as `oids`.
+async def _snmp_get_async(
+    snmp_asyncio, dispatcher, semaphore, host, oids, port, timeout, retries, community
+):
+    get_cmd = getattr(snmp_asyncio, "get_cmd", None) or snmp_asyncio.getCmd
+    # Only the full engine API takes a context
+    context = (
+        [] if hasattr(snmp_asyncio, "SnmpDispatcher") else [snmp_asyncio.ContextData()]
+    )
+    async with semaphore:
+        with metrics.timed("snmp_get"):
+            errorIndication, errorStatus, errorIndex, varBinds = await get_cmd(
+                dispatcher,
+                snmp_asyncio.CommunityData(community, mpModel=0),
+                await _udp_target(snmp_asyncio, host, port, timeout, retries),
+                *context,
+                *(
+                    snmp_asyncio.ObjectType(snmp_asyncio.ObjectIdentity(oid))
+                    for oid in oids
+                ),
+                lookupMib=False,
             )
-            break
 
-        else:
-            for varBind in varBinds:
-                return varBind
+    if errorIndication:
+        metrics.error("snmp_get")
+        raise ValueError(f"{host}: {errorIndication}")
+
+    if errorStatus:
+        metrics.error("snmp_get")
+        raise SnmpVarBindError(
+            "%s: %s at %s"
+            % (
+                host,
+                errorStatus.prettyPrint(),
+                errorIndex and varBinds[int(errorIndex) - 1][0] or "?",
+            ),
+            int(errorIndex),
+        )
+
+    if len(varBinds) != len(oids):
+        metrics.error("snmp_get")
+        raise ValueError(f"{host}: Expected {len(oids)} values, got {len(varBinds)}")
+    return varBinds
+
+
+# Get the whole system group in one GET. SNMPv1 fails the whole PDU if the
+# agent doesn't have one of the OIDs, so drop that one and ask again. Only
+# sysName is a must.
+async def _snmp_get_system_info(
+    snmp_asyncio, dispatcher, semaphore, host, port, timeout, retries, community
+):
+    names = list(SNMP_SYSTEM_OIDS)
+    while True:
+        try:
+            varBinds = await _snmp_get_async(
+                snmp_asyncio,
+                dispatcher,
+                semaphore,
+                host,
+                [SNMP_SYSTEM_OIDS[name] for name in names],
+                port,
+                timeout,
+                retries,
+                community,
+            )
+        except SnmpVarBindError as e:
+            if not 1 < e.index <= len(names):
+                raise
+            names.pop(e.index - 1)
+            continue
+        return {
+            name: varBind[1].prettyPrint() for name, varBind in zip(names, varBinds)
+        }
+
+
+async def _snmp_get_many(hosts, port, concurrency, timeout, retries, community):
+    snmp_asyncio = _snmp_asyncio()
+    dispatcher = _snmp_dispatcher(snmp_asyncio)
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        results = await asyncio.gather(
+            *(
+                _snmp_get_system_info(
+                    snmp_asyncio,
+                    dispatcher,
+                    semaphore,
+                    h,
+                    port,
+                    timeout,
+                    retries,
+                    community,
+                )
+                for h in hosts
+            ),
+            return_exceptions=True,
+        )
+    finally:
+        _close_dispatcher(dispatcher)
+    return dict(zip(hosts, results))
+
+
+# Get the system group (sysName, sysDescr, sysObjectID and sysLocation) from
+# a whole bunch of routers at once, with one GET each.
+# Returns a dict of IP -> {name: value}. If a router could not be reached,
+# its value is the exception that was raised instead, so one dead router
+# does not stop the rest of the batch.
+@metrics.timed("snmp_resolve")
+def snmp_get_system_info(
+    ips, concurrency=32, timeout=1, retries=2, port=161, community="public"
+):
+    ips = list(dict.fromkeys(ips))
+    if len(ips) == 0:
+        return {}
+
+    results = asyncio.run(
+        _snmp_get_many(ips, port, concurrency, timeout, retries, community)
+    )
+    for ip, result in results.items():
+        if isinstance(result, Exception):
+            logging.error(f"Could not get SNMP system info for {ip}: {result}")
+    metrics.count("snmp_hosts", len(ips))
+    return results
 
 
-# Get SNMP info from router
-def snmp_get_hostname(ip):
-    snmp_host_name = "1.3.6.1.2.1.1.5.0"
-    data = snmp_get(ip, snmp_host_name)
-    if data is not None:
-        return data[1].prettyPrint()
-    logging.error("Could not get SNMP Hostname")
-    raise ValueError("Could not get SNMP Hostname")
+# Same as snmp_get_system_info, but only returns the hostnames (sysName)
+def snmp_get_hostnames(ips, **kwargs):
+    return {
+        ip: info if isinstance(info, Exception) else info["sysName"]
+        for ip, info in snmp_get_system_info(ips, **kwargs).items()
+    }
@@ -0,0 +1,85 @@
+import os
+import re
+import json
+from dataclasses import dataclass
+
+DEFAULT_TEMPLATE = "Network Generic Device by SNMP"
+
+
+# How to monitor one kind of router: which Zabbix template to give it, and
+# which SNMP community/version Zabbix should poll it with.
+# A rule matches a router when its sysObjectID is under `sysObjectID` (an
+# OID prefix, like 1.3.6.1.4.1.14988 for MikroTik), and its sysDescr matches
+# the `sysDescr` regex (case-insensitive). Leave either out to match anything.
+@dataclass
+class O2ZSnmpRule:
+    template: str = DEFAULT_TEMPLATE
+    community: str = "public"
+    version: int = 2
+    sysObjectID: str = None
+    sysDescr: str = None
+    name: str = None
+
+    def __post_init__(self):
+        # Zabbix's SNMPv3 interfaces need a whole lot more than a community
+        if self.version not in (1, 2):
+            raise ValueError(
+                f"SNMP rule {self.name or self.template}: version must be 1 or 2"
+            )
+        self._descr = (
+            re.compile(self.sysDescr, re.IGNORECASE)
+            if self.sysDescr is not None
+            else None
+        )
+
+    def matches(self, info):
+        if self.sysObjectID is not None:
+            oid = info.get("sysObjectID", "")
+            prefix = self.sysObjectID.strip(".")
+            if oid != prefix and not oid.startswith(f"{prefix}."):
+                return False
+        if self._descr is not None:
+            if not self._descr.search(info.get("sysDescr", "")):
+                return False
+        return True
+
+
+# An ordered table of O2ZSnmpRules. The first one that matches a router
+# wins, and routers nothing matches get the default rule.
+# The table is a JSON list of rules, from the file in P2Z_SNMP_RULES (see
+# snmp_rules.sample.json). The default rule comes from P2Z_SNMP_TEMPLATE,
+# P2Z_SNMP_ZABBIX_COMMUNITY and P2Z_SNMP_ZABBIX_VERSION.
+class O2ZSnmpRules:
+    def __init__(self, rules=None, default=None):
+        if default is None:
+            default = O2ZSnmpRule(
+                template=os.getenv("P2Z_SNMP_TEMPLATE") or DEFAULT_TEMPLATE,
+                community=os.getenv("P2Z_SNMP_ZABBIX_COMMUNITY") or "public",
+                version=int(os.getenv("P2Z_SNMP_ZABBIX_VERSION") or 2),
+                name="default",
+            )
+        self.rules = rules or []
+        self.default = default
+
+    @classmethod
+    def load(cls, path=None):
+        if path is None:
+            path = os.getenv("P2Z_SNMP_RULES")
+        if not path:
+            return cls()
+        with open(path) as f:
+            rules = [O2ZSnmpRule(**rule) for rule in json.load(f)]
+        return cls(rules)
+
+    # The rule for a router, from what snmp_get_system_info() found out
+    # about it (or None, if we don't know anything)
+    def match(self, info):
+        if info is not None:
+            for rule in self.rules:
+                if rule.matches(info):
+                    return rule
+        return self.default
+
+    # Every template name the table could hand out
+    def templates(self):
+        return {r.template for r in [*self.rules, self.default]}
@@ -0,0 +1,208 @@
+import random
+from array import array
+from bisect import bisect_left
+
+
+# The mesh's router graph, merged across OSPF areas, in a compact CSR layout:
+# routers are interned to ints (ips[i] is router i's IP), and router i's
+# neighbors are neighbors[offsets[i]:offsets[i + 1]]. Links are undirected,
+# and a pair of routers linked in several areas (or from both ends) counts
+# as one link.
+# Everything here is a linear pass over those two arrays, except
+# betweenness(), so scoring a mesh with tens of thousands of links takes
+# milliseconds.
+class O2ZTopology:
+    def __init__(self, ips, offsets, neighbors):
+        self.ips = ips
+        self.index = {ip: i for i, ip in enumerate(ips)}
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self._cuts = None
+
+    # Build from (area, router_ip, [neighbor_ip...]) tuples, like the ones
+    # O2ZExplorer.iter_router_links() gives back. Neighbors that aren't
+    # described as routers themselves are still part of the graph.
+    @classmethod
+    def from_links(cls, router_links):
+        index = {}
+        ips = []
+
+        def intern(ip):
+            i = index.get(ip)
+            if i is None:
+                i = index[ip] = len(ips)
+                ips.append(ip)
+            return i
+
+        edges = set()
+        for area, router_ip, links in router_links:
+            a = intern(router_ip)
+            for neighbor_ip in links:
+                if neighbor_ip is None or neighbor_ip == router_ip:
+                    continue
+                b = intern(neighbor_ip)
+                edges.add((a, b) if a < b else (b, a))
+
+        n = len(ips)
+        degree = array("l", [0]) * n
+        for a, b in edges:
+            degree[a] += 1
+            degree[b] += 1
+
+        offsets = array("l", [0]) * (n + 1)
+        for i in range(n):
+            offsets[i + 1] = offsets[i] + degree[i]
+
+        neighbors = array("l", [0]) * offsets[n]
+        fill = array("l", offsets[:n])
+        for a, b in edges:
+            neighbors[fill[a]] = b
+            fill[a] += 1
+            neighbors[fill[b]] = a
+            fill[b] += 1
+        return cls(ips, offsets, neighbors)
+
+    def __len__(self):
+        return len(self.ips)
+
+    def link_count(self):
+        return len(self.neighbors) // 2
+
+    def neighbors_of(self, ip):
+        i = self.index[ip]
+        return [
+            self.ips[j] for j in self.neighbors[self.offsets[i] : self.offsets[i + 1]]
+        ]
+
+    # Number of distinct neighbors of every router, by router id
+    def degrees(self):
+        offsets = self.offsets
+        return array("l", map(int.__sub__, offsets[1:], offsets[:-1]))
+
+    def degree_dict(self):
+        return dict(zip(self.ips, self.degrees()))
+
+    # How many routers have at least each of `thresholds` neighbors, from one
+    # sort of the degrees. Returns a dict of threshold -> count.
+    def count_at_least(self, thresholds):
+        degrees = sorted(self.degrees())
+        return {t: len(degrees) - bisect_left(degrees, t) for t in thresholds}
+
+    # The routers with at least `threshold` neighbors
+    def at_least(self, threshold):
+        return [ip for ip, d in zip(self.ips, self.degrees()) if d >= threshold]
+
+    # For every articulation point (a router whose failure splits the mesh),
+    # how many other routers it would cut off from the biggest piece that's
+    # left. Returns a dict of router IP -> routers stranded.
+    def articulation_points(self):
+        if self._cuts is None:
+            self._cuts = self._find_cuts()
+        return {self.ips[i]: stranded for i, stranded in self._cuts.items()}
+
+    # The routers whose failure would strand at least `min_stranded` others,
+    # most critical first
+    def critical(self, min_stranded=1):
+        cuts = self.articulation_points()
+        return sorted(
+            (ip for ip, stranded in cuts.items() if stranded >= min_stranded),
+            key=lambda ip: cuts[ip],
+            reverse=True,
+        )
+
+    # Iterative Tarjan (no recursion limit on long chains of routers), which
+    # also keeps DFS subtree sizes, so we know how big each split-off piece is
+    def _find_cuts(self):
+        n = len(self.ips)
+        offsets, neighbors = self.offsets, self.neighbors
+        disc = array("l", [-1]) * n
+        low = array("l", [0]) * n
+        size = array("l", [1]) * n
+        cuts = {}
+        clock = 0
+
+        for root in range(n):
+            if disc[root] != -1:
+                continue
+
+            # Pieces each vertex would split off: sizes of the child
+            # subtrees that can't reach above it
+            pieces = {}
+            disc[root] = low[root] = clock
+            clock += 1
+            stack = [(root, -1, offsets[root])]
+            while stack:
+                v, parent, k = stack[-1]
+                if k < offsets[v + 1]:
+                    stack[-1] = (v, parent, k + 1)
+                    w = neighbors[k]
+                    if disc[w] == -1:
+                        disc[w] = low[w] = clock
+                        clock += 1
+                        stack.append((w, v, offsets[w]))
+                    elif w != parent and disc[w] < low[v]:
+                        low[v] = disc[w]
+                    continue
+
+                stack.pop()
+                if parent == -1:
+                    continue
+                size[parent] += size[v]
+                if low[v] < low[parent]:
+                    low[parent] = low[v]
+                if low[v] >= disc[parent]:
+                    pieces.setdefault(parent, []).append(size[v])
+
+            comp_size = size[root]
+            for v, split in pieces.items():
+                # The root only splits the mesh if it has several subtrees
+                if v == root and len(split) < 2:
+                    continue
+                rest = comp_size - 1 - sum(split)
+                cuts[v] = comp_size - 1 - max(max(split), rest)
+        return cuts
+
+    # Betweenness centrality (unweighted, Brandes), normalized to 0-1 by the
+    # number of router pairs. This one's O(routers * links), so on a big mesh
+    # pass `samples` to only start from that many random routers, which
+    # estimates it well enough to rank routers. Returns a dict of IP -> score.
+    def betweenness(self, samples=None, seed=0):
+        n = len(self.ips)
+        offsets, neighbors = self.offsets, self.neighbors
+        sources = range(n)
+        if samples is not None and samples < n:
+            sources = random.Random(seed).sample(range(n), samples)
+        scale = n / len(sources) if len(sources) > 0 else 0
+
+        centrality = [0.0] * n
+        for s in sources:
+            # Breadth-first from s, counting shortest paths to each router
+            order = [s]
+            paths = [0] * n
+            paths[s] = 1
+            dist = [-1] * n
+            dist[s] = 0
+            for v in order:
+                next_dist = dist[v] + 1
+                for w in neighbors[offsets[v] : offsets[v + 1]]:
+                    if dist[w] < 0:
+                        dist[w] = next_dist
+                        order.append(w)
+                    if dist[w] == next_dist:
+                        paths[w] += paths[v]
+
+            # Then back up the tree, handing each router's dependency to the
+            # routers one hop closer to s
+            dependency = [0.0] * n
+            for w in reversed(order):
+                prev_dist = dist[w] - 1
+                share = (1 + dependency[w]) / paths[w]
+                for v in neighbors[offsets[w] : offsets[w + 1]]:
+                    if dist[v] == prev_dist:
+                        dependency[v] += paths[v] * share
+                if w != s:
+                    centrality[w] += dependency[w]
+
+        # Every pair was counted from both ends
+        norm = scale / ((n - 1) * (n - 2)) if n > 2 else 0
+        return {ip: c * norm for ip, c in zip(self.ips, centrality)}
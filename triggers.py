@@ -2,21 +2,120 @@
 import os
 import time
 import weakref
+import itertools
 import psycopg2
 from prettytable import PrettyTable
 from dataclasses import dataclass
+from rollup import O2ZTriggerRollup, day_start, SECONDS_PER_DAY
+from metrics import metrics
 
 
-@dataclass
+# The events we count as noise: events of triggers of priority >= 3 on hosts
+# in the group. Hosts are matched to triggers and groups with EXISTS, so an
+# event is counted once per host, however many items its trigger uses,
+# without multiplying the events rows and then collapsing them again.
+# `since` and `group_id` are placeholders for whichever parameter style the
+# caller uses, as is `until` (events before it), if given. `events` can be a
+# subquery over the events table, as long as it keeps its columns.
+def noisy_events_sql(since, group_id, events="events", until=None):
+    until_sql = "" if until is None else f"AND e.clock < {until}"
+    return f"""
+        FROM {events} e
+        JOIN triggers t ON t.triggerid = e.objectid
+        JOIN hosts h ON EXISTS (
+            SELECT 1
+            FROM functions f
+            JOIN items i ON i.itemid = f.itemid
+            WHERE f.triggerid = t.triggerid
+              AND i.hostid = h.hostid
+        )
+        WHERE e.source = 0
+          AND e.object = 0
+          AND e.clock > {since}
+          {until_sql}
+          AND t.flags IN (0, 4)
+          AND t.priority >= 3
+          AND EXISTS (
+            SELECT 1
+            FROM hosts_groups hg
+            WHERE hg.hostid = h.hostid
+              AND hg.groupid = {group_id}
+          )
+    """
+
+
+# The leaderboard: noisy events counted per trigger, loudest first. A limit
+# of NULL means no limit.
+def _noisiest_triggers_sql(since, group_id, limit):
+    return f"""
+        SELECT h.name, t.description, t.priority, COUNT(*) AS cnt_event
+        {noisy_events_sql(since, group_id)}
+        GROUP BY h.name, t.description, t.priority
+        ORDER BY cnt_event DESC
+        LIMIT {limit}
+    """
+
+
+# Per-trigger flap statistics: how many times it fired, how long its
+# problems lasted on average, and how soon it fired again after recovering.
+# A flap is a re-fire within `flap_window` seconds of the last recovery.
+# The problems are numbered per trigger with a window function, so all of
+# this is worked out in the DB in one pass over `events`, without pulling
+# any events into Python.
+def flapping_triggers_sql(since, group_id, flap_window):
+    problems = f"""(
+        SELECT p.eventid, p.source, p.object, p.objectid, p.clock,
+               r.clock AS r_clock,
+               LAG(r.clock) OVER (
+                   PARTITION BY p.objectid ORDER BY p.clock, p.eventid
+               ) AS prev_r_clock
+        FROM events p
+        LEFT JOIN event_recovery er ON er.eventid = p.eventid
+        LEFT JOIN events r ON r.eventid = er.r_eventid
+        WHERE p.source = 0
+          AND p.object = 0
+          AND p.value = 1
+          AND p.clock > {since}
+    )"""
+    return f"""
+        SELECT h.name, t.description, t.priority,
+               COUNT(*) AS problems,
+               COUNT(*) FILTER (
+                   WHERE e.clock - e.prev_r_clock < {flap_window}
+               ) AS flaps,
+               AVG(e.r_clock - e.clock)::float8 AS mean_duration,
+               AVG(e.clock - e.prev_r_clock)::float8 AS mean_refire
+        {noisy_events_sql(since, group_id, events=problems)}
+        GROUP BY h.name, t.description, t.priority
+        ORDER BY flaps DESC, problems DESC
+    """
+
+
+@dataclass(slots=True)
 class O2ZTriggerRow:
     host: str
     description: str
     priority: int
     count: int
+    delta: int = None
+
+
+# Durations are in seconds, and None when there's nothing to average
+@dataclass(slots=True)
+class O2ZTriggerFlapRow:
+    host: str
+    description: str
+    priority: int
+    problems: int
+    flaps: int
+    mean_duration: float = None
+    mean_refire: float = None
 
 
 class O2ZTriggers:
-    def __init__(self):
+    # Pass rollup=True to keep per-day counts in a local O2ZTriggerRollup, so
+    # only the days that haven't been counted yet are queried.
+    def __init__(self, rollup=False):
         db_params = {
             "host": os.getenv("P2Z_PGSQL_HOST"),
             "database": os.getenv("P2Z_PGSQL_DB"),
@@ -27,7 +126,15 @@ class O2ZTriggers:
 
         self.conn = psycopg2.connect(**db_params)
         self._finalizer = weakref.finalize(self, self._cleanup_conn, self.conn)
+        # Rows per round trip when streaming through a server-side cursor
+        self.itersize = int(os.getenv("P2Z_PGSQL_ITERSIZE", default=2000))
+        self.flap_window = int(os.getenv("P2Z_FLAP_WINDOW", default=1800))
+        self._streams = itertools.count()
         self.trigger_list = None
+        self.windows = None
+        self.flap_list = None
+        self.rollup = O2ZTriggerRollup() if rollup else None
+        self._prepared = False
 
     @staticmethod
     def _cleanup_conn(conn):
@@ -38,41 +145,296 @@ class O2ZTriggers:
     # Not that we need it, but this is the source code for the top triggers page.
     # It has a few queries we could use
     # https://git.zabbix.com/projects/ZT/repos/rsm-scripts/browse/ui/toptriggers.php#26
+    @metrics.timed("noisy_triggers")
     def get_noisiest_triggers(self, group_id, days_ago, limit):
-        cursor = self.conn.cursor()
-        current_time = time.time()
-        timestamp = current_time - (
-            days_ago * 24 * 60 * 60
-        )  # 7 days * 24 hours * 60 minutes * 60 seconds
-        query = f"""
-        SELECT h.name, t.description, t.priority, COUNT(DISTINCT e.eventid) AS cnt_event
-        FROM triggers t, events e, functions f, items i, hosts h, hosts_groups hg
-        WHERE t.triggerid = e.objectid
-          AND e.source = 0
-          AND e.object = 0
-          AND e.clock > {timestamp} 
-          AND t.flags IN ('0', '4')
-          AND t.priority >= 3
-          AND f.triggerid = t.triggerid
-          AND i.itemid = f.itemid
-          AND i.hostid = h.hostid
-          AND h.hostid = hg.hostid
-          AND hg.groupid = {group_id}
-        GROUP BY h.name, t.description, t.priority  -- Added h.name to GROUP BY
-        ORDER BY cnt_event DESC
-        LIMIT {limit} OFFSET 0;
-        """
+        if self.rollup is not None:
+            return self.get_noisiest_triggers_rollup(group_id, days_ago, limit)
 
-        cursor.execute(query)
+        self._prepare_noisiest_triggers()
+        cursor = self.conn.cursor()
+        cursor.execute(*self._noisiest_triggers_query(group_id, days_ago, limit))
         result = cursor.fetchall()
         cursor.close()
 
+        self.trigger_list = []
+        for r in result:
+            self.trigger_list.append(O2ZTriggerRow(r[0], r[1], r[2], r[3]))
+        return result
+
+    # Yield every noisy trigger (no leaderboard limit) as O2ZTriggerRows,
+    # loudest first. The rows come through a server-side cursor, itersize at
+    # a time, so a full dump never has to fit in memory.
+    def iter_noisiest_triggers(self, group_id, days_ago, itersize=None):
+        timestamp = int(time.time() - days_ago * SECONDS_PER_DAY)
+        for r in self._stream(
+            _noisiest_triggers_sql("%(since)s", "%(group_id)s", "NULL"),
+            {"since": timestamp, "group_id": group_id},
+            itersize,
+        ):
+            yield O2ZTriggerRow(*r)
+
+    # The triggers that flap the most (see flapping_triggers_sql), up to
+    # `limit` of them. Sets flap_list.
+    @metrics.timed("flapping_triggers")
+    def get_flappiest_triggers(self, group_id, days_ago, limit):
+        query, params = self._flapping_triggers_query(group_id, days_ago)
+        cursor = self.conn.cursor()
+        cursor.execute(f"{query} LIMIT %(limit)s", {**params, "limit": limit})
+        self.flap_list = [O2ZTriggerFlapRow(*r) for r in cursor]
+        cursor.close()
+        return self.flap_list
+
+    # Yield the flap statistics of every noisy trigger as
+    # O2ZTriggerFlapRows, through a server-side cursor
+    def iter_flapping_triggers(self, group_id, days_ago, itersize=None):
+        for r in self._stream(
+            *self._flapping_triggers_query(group_id, days_ago), itersize
+        ):
+            yield O2ZTriggerFlapRow(*r)
+
+    def _flapping_triggers_query(self, group_id, days_ago):
+        return (
+            flapping_triggers_sql("%(since)s", "%(group_id)s", "%(flap_window)s"),
+            {
+                "since": int(time.time() - days_ago * SECONDS_PER_DAY),
+                "group_id": group_id,
+                "flap_window": self.flap_window,
+            },
+        )
+
+    # Run a query on a named (server-side) cursor, and yield its rows as
+    # they're fetched, itersize at a time. Every stream gets its own cursor
+    # name, so several can be open on the connection at once.
+    def _stream(self, query, params, itersize=None):
+        cursor = self.conn.cursor(name=f"o2z_stream_{next(self._streams)}")
+        cursor.itersize = self.itersize if itersize is None else itersize
+        try:
+            cursor.execute(query, params)
+            yield from cursor
+        finally:
+            cursor.close()
+
+    # Prepare the leaderboard query once per connection, so Postgres can
+    # reuse its plan
+    def _prepare_noisiest_triggers(self):
+        if self._prepared:
+            return
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            PREPARE o2z_noisiest_triggers (integer, bigint, integer) AS
+            {_noisiest_triggers_sql("$1", "$2", "$3")}
+            """)
+        cursor.close()
+        self._prepared = True
+
+    # A limit of None means no limit (LIMIT NULL)
+    def _noisiest_triggers_query(self, group_id, days_ago, limit):
+        timestamp = int(time.time() - days_ago * SECONDS_PER_DAY)
+        return (
+            "EXECUTE o2z_noisiest_triggers (%s, %s, %s)",
+            (timestamp, group_id, limit),
+        )
+
+    # Same as get_noisiest_triggers, over the same days_ago window. The
+    # complete UTC days in it come from the rollup store, and only the days it
+    # doesn't have yet, plus the partial days at either end (the one the
+    # window starts in, and today), are counted in the Zabbix DB.
+    def get_noisiest_triggers_rollup(self, group_id, days_ago, limit):
+        since = int(time.time() - days_ago * SECONDS_PER_DAY)
+        today_counts = self._refresh_rollup(
+            group_id, day_start(since) + SECONDS_PER_DAY
+        )
+        counts = self._window_counts(group_id, since, today_counts)
+
+        result = [(*key, cnt) for key, cnt in counts.items()]
         result.sort(key=lambda tup: tup[3], reverse=True)
+        result = result[:limit]
+
         self.trigger_list = []
         for r in result:
             self.trigger_list.append(O2ZTriggerRow(r[0], r[1], r[2], r[3]))
         return result
 
+    # Count the days from `start` that the rollup store doesn't have yet, and
+    # store them. Returns today's counts so far, which are never stored.
+    def _refresh_rollup(self, group_id, start):
+        today = day_start(time.time())
+        missing = self.rollup.missing_days(group_id, start, today)
+        metrics.cache(
+            "trigger_rollup",
+            hits=(today - start) // SECONDS_PER_DAY - len(missing),
+            misses=len(missing),
+        )
+        since = missing[0] if len(missing) > 0 else today
+
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT (e.clock / %(day)s) * %(day)s AS day, h.name, t.description,
+                   t.priority, COUNT(*) AS cnt_event
+            {noisy_events_sql("%(since)s", "%(group_id)s")}
+            GROUP BY day, h.name, t.description, t.priority
+            """,
+            {"day": SECONDS_PER_DAY, "since": since - 1, "group_id": group_id},
+        )
+        new_rows = cursor.fetchall()
+        cursor.close()
+
+        self.rollup.store(group_id, missing, new_rows)
+        self.rollup.prune(keep_from=start)
+
+        return {
+            (host, description, priority): cnt
+            for day, host, description, priority, cnt in new_rows
+            if day >= today
+        }
+
+    # Counts of the events in (after, until], or (after, now] if until is
+    # None. The complete days in between come from the rollup store (so
+    # _refresh_rollup has to have been run over them), and the partial days
+    # at either end from the Zabbix DB.
+    def _window_counts(self, group_id, after, today_counts, until=None):
+        start = day_start(after) + SECONDS_PER_DAY
+        partial = [(after, start)]
+        if until is None:
+            counts = self._rollup_counts(group_id, start, today_counts)
+        else:
+            end = day_start(until)
+            counts = self._rollup_counts(group_id, start, today_counts, end=end)
+            partial.append((end - 1, until + 1))
+        for part in partial:
+            for key, cnt in self._live_counts(group_id, *part).items():
+                counts[key] = counts.get(key, 0) + cnt
+        return counts
+
+    # Counts of the events in (after, until), straight from the Zabbix DB,
+    # for the partial days the rollup store can't answer
+    def _live_counts(self, group_id, after, until):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT h.name, t.description, t.priority, COUNT(*) AS cnt_event
+            {noisy_events_sql("%(after)s", "%(group_id)s", until="%(until)s")}
+            GROUP BY h.name, t.description, t.priority
+            """,
+            {"after": after, "until": until, "group_id": group_id},
+        )
+        counts = {(r[0], r[1], r[2]): r[3] for r in cursor}
+        cursor.close()
+        return counts
+
+    # Stored counts from `start` up to now, merged with today's counts so far
+    def _rollup_counts(self, group_id, start, today_counts, end=None):
+        today = day_start(time.time())
+        if end is not None and end <= today:
+            return self.rollup.counts(group_id, start, end)
+
+        counts = self.rollup.counts(group_id, start, today)
+        for key, cnt in today_counts.items():
+            counts[key] = counts.get(key, 0) + cnt
+        return counts
+
+    # Get a leaderboard for each window (in days) at once. Each row's delta is
+    # how its count changed compared to the window of the same length right
+    # before it (week-over-week, for a 7 day window).
+    # Everything is counted in a single pass over `events`, with one
+    # conditional aggregate per window and per previous window.
+    # Returns a dict of window -> [O2ZTriggerRow]. trigger_list is set to the
+    # first window's leaderboard.
+    @metrics.timed("noisy_triggers_windows")
+    def get_noisiest_triggers_windows(self, group_id, windows, limit):
+        if self.rollup is not None:
+            return self.get_noisiest_triggers_windows_rollup(group_id, windows, limit)
+
+        cursor = self.conn.cursor()
+        cursor.execute(*self._noisiest_triggers_windows_query(group_id, windows))
+        result = cursor.fetchall()
+        cursor.close()
+
+        self.windows = {}
+        for i, w in enumerate(windows):
+            rows = [
+                O2ZTriggerRow(
+                    r[0], r[1], r[2], r[3 + 2 * i], r[3 + 2 * i] - r[4 + 2 * i]
+                )
+                for r in result
+                if r[3 + 2 * i] > 0
+            ]
+            rows.sort(key=lambda row: row.count, reverse=True)
+            self.windows[w] = rows[:limit]
+
+        self.trigger_list = self.windows[windows[0]]
+        return self.windows
+
+    def _noisiest_triggers_windows_query(self, group_id, windows):
+        current_time = time.time()
+        params = {
+            "since": int(current_time - 2 * max(windows) * SECONDS_PER_DAY),
+            "group_id": group_id,
+        }
+        columns = []
+        for i, w in enumerate(windows):
+            params[f"start_{i}"] = int(current_time - w * SECONDS_PER_DAY)
+            params[f"prev_{i}"] = int(current_time - 2 * w * SECONDS_PER_DAY)
+            columns.append(f"COUNT(*) FILTER (WHERE e.clock > %(start_{i})s)")
+            columns.append(
+                f"COUNT(*) FILTER "
+                f"(WHERE e.clock > %(prev_{i})s AND e.clock <= %(start_{i})s)"
+            )
+
+        query = f"""
+            SELECT h.name, t.description, t.priority, {", ".join(columns)}
+            {noisy_events_sql("%(since)s", "%(group_id)s")}
+            GROUP BY h.name, t.description, t.priority
+        """
+        return query, params
+
+    # Run the leaderboard query (or the multi-window one, if windows are
+    # given) under EXPLAIN (ANALYZE, BUFFERS), so the plan can be checked
+    # against this Zabbix DB's indexes. The query only runs the once, under
+    # ANALYZE, which reports how long it took. Returns the plan, with timings.
+    def explain_noisiest_triggers(self, group_id, days_ago, limit, windows=None):
+        cursor = self.conn.cursor()
+        timings = []
+        if windows:
+            query, params = self._noisiest_triggers_windows_query(group_id, windows)
+        else:
+            start = time.perf_counter()
+            self._prepare_noisiest_triggers()
+            timings.append(f"Prepare: {(time.perf_counter() - start) * 1000:.3f} ms")
+            query, params = self._noisiest_triggers_query(group_id, days_ago, limit)
+
+        cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {query}", params)
+        plan = [r[0] for r in cursor.fetchall()]
+        cursor.close()
+        return "\n".join(plan + timings)
+
+    # get_noisiest_triggers_windows, over the same windows, with the complete
+    # days in them counted from the rollup
+    def get_noisiest_triggers_windows_rollup(self, group_id, windows, limit):
+        current_time = time.time()
+        today_counts = self._refresh_rollup(
+            group_id,
+            day_start(current_time - 2 * max(windows) * SECONDS_PER_DAY)
+            + SECONDS_PER_DAY,
+        )
+
+        self.windows = {}
+        for w in windows:
+            start = int(current_time - w * SECONDS_PER_DAY)
+            prev = int(current_time - 2 * w * SECONDS_PER_DAY)
+            counts = self._window_counts(group_id, start, today_counts)
+            prev_counts = self._window_counts(group_id, prev, today_counts, until=start)
+            rows = [
+                O2ZTriggerRow(*key, cnt, cnt - prev_counts.get(key, 0))
+                for key, cnt in counts.items()
+            ]
+            rows.sort(key=lambda row: row.count, reverse=True)
+            self.windows[w] = rows[:limit]
+
+        self.trigger_list = self.windows[windows[0]]
+        return self.windows
+
     def pretty_print(self):
         if self.trigger_list is not None:
             t = PrettyTable()
@@ -95,3 +457,59 @@ class O2ZTriggers:
                 t.add_row([r.host, r.description, r.priority, r.count])
             return t
         return None
+
+    # Pretty print every window's leaderboard, with the change in count
+    # from the previous window
+    def pretty_print_windows(self):
+        if self.windows is None:
+            return None
+
+        title = os.getenv("P2Z_CSV_TITLE")
+        if title is None:
+            raise ValueError(
+                "P2Z_CSV_TITLE is not set. Please set a title for this data!"
+            )
+
+        tables = []
+        for w, rows in self.windows.items():
+            t = PrettyTable()
+            t.title = f"Last {w} days"
+            t.field_names = [*filter(None, title.title().split(",")), "Change"]
+            for r in rows:
+                t.add_row([r.host, r.description, r.priority, r.count, f"{r.delta:+}"])
+            tables.append(f"{t}")
+        return "\n\n".join(tables)
+
+    # Pretty print the flap leaderboard, durations in minutes
+    def pretty_print_flaps(self):
+        if self.flap_list is None:
+            return None
+
+        t = PrettyTable()
+        t.title = f"Flaps (re-fired within {self.flap_window // 60} minutes)"
+        t.field_names = [
+            "Host",
+            "Description",
+            "Priority",
+            "Problems",
+            "Flaps",
+            "Mean Duration (min)",
+            "Mean Re-fire (min)",
+        ]
+        for r in self.flap_list:
+            t.add_row(
+                [
+                    r.host,
+                    r.description,
+                    r.priority,
+                    r.problems,
+                    r.flaps,
+                    _minutes(r.mean_duration),
+                    _minutes(r.mean_refire),
+                ]
+            )
+        return t
+
+
+def _minutes(seconds):
+    return "-" if seconds is None else f"{seconds / 60:.1f}"
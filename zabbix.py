@@ -1,61 +1,146 @@
 import os
 import logging
-from pyzabbix.api import ZabbixAPI, ZabbixAPIException
+from pyzabbix.api import ZabbixAPIException
+from zabbix_session import O2ZZabbixSession
 from explorer import O2ZExplorer
+from enrollment import O2ZEnrollment
+from reconcile import O2ZReconciler
+from hostname_cache import O2ZHostnameCache
+from snmp_rules import O2ZSnmpRules
+from metrics import metrics
 import snmp
 
 
+# In-memory lookup of the hosts Zabbix already monitors, by name and by IP
+class O2ZHostIndex:
+    def __init__(self, hosts):
+        self.by_name = {}
+        self.by_ip = {}
+        for h in hosts:
+            self.by_name[h["host"]] = h
+            for interface in h.get("interfaces", []):
+                ip = interface.get("ip")
+                if ip:
+                    self.by_ip[ip] = h
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def has_ip(self, ip):
+        return ip in self.by_ip
+
+    def has_name(self, host_name):
+        return host_name in self.by_name
+
+
 class O2ZZabbix:
     def __init__(self):
         zabbix_url = os.getenv("P2Z_ZABBIX_URL")
         zabbix_uname = os.getenv("P2Z_ZABBIX_UNAME")
         zabbix_pword = os.getenv("P2Z_ZABBIX_PWORD")
-        if zabbix_url is None or zabbix_uname is None or zabbix_pword is None:
+        zabbix_token = os.getenv("P2Z_ZABBIX_API_TOKEN") or None
+        if zabbix_url is None or (
+            zabbix_token is None and (zabbix_uname is None or zabbix_pword is None)
+        ):
             logging.error(f"Zabbix credentials not provided")
             raise ValueError("Zabbix credentials not provided.")
         logging.info("Logging into zabbix...")
-        self.zapi = ZabbixAPI(zabbix_url)
-        self.zapi.login(zabbix_uname, zabbix_pword)
+        self.zapi = O2ZZabbixSession(zabbix_url)
+        self.zapi.connect(zabbix_uname, zabbix_pword, api_token=zabbix_token)
         logging.info(f"Logged into zabbix @ {zabbix_url}")
 
+        self.snmp_concurrency = int(os.getenv("P2Z_SNMP_CONCURRENCY", default=32))
+        self.snmp_timeout = float(os.getenv("P2Z_SNMP_TIMEOUT", default=1))
+        self.snmp_retries = int(os.getenv("P2Z_SNMP_RETRIES", default=2))
+        self.snmp_port = int(os.getenv("P2Z_SNMP_PORT", default=161))
+        self.snmp_community = os.getenv("P2Z_SNMP_COMMUNITY", default="public")
+        self.snmp_rules = O2ZSnmpRules.load()
+        self.zabbix_chunk_size = int(os.getenv("P2Z_ZABBIX_CHUNK_SIZE", default=50))
+        self.zabbix_page_size = int(os.getenv("P2Z_ZABBIX_PAGE_SIZE", default=1000))
+        self.hostname_cache = O2ZHostnameCache()
+
+        # These don't change, so only look them up once per session
+        self._hostgroupid = None
+        self._templateids = None
+
     # Get the hostgroup, and create it if it doesn't exist
     def get_or_create_hostgroup(self):
+        if self._hostgroupid is not None:
+            return self._hostgroupid
         nycmesh_node_hostgroup = "NYCMeshNodes"
         try:
             groupid = self.zapi.hostgroup.get(filter={"name": nycmesh_node_hostgroup})[
                 0
             ].get("groupid")
-            return groupid
         except (ZabbixAPIException, IndexError):
             logging.warn(f"Did not find host group. Creating {nycmesh_node_hostgroup}")
             groupid = self.zapi.hostgroup.create(name=nycmesh_node_hostgroup)[
                 "groupids"
             ][0]
-            return groupid
+        self._hostgroupid = groupid
+        return groupid
 
-    # Get the templateID for the generic SNMP device
+    # Get the templateID for the generic SNMP device (the SNMP rules table's
+    # default template). Every template in the rules table is looked up in
+    # the same call, for snmp_host_params() to pick from.
     def get_generic_snmp_templateid(self):
-        return int(
-            self.zapi.template.get(filter={"name": "Network Generic Device by SNMP"})[
-                0
-            ].get("templateid")
-        )
+        if self._templateids is None:
+            names = sorted(self.snmp_rules.templates())
+            templates = self.zapi.template.get(
+                filter={"name": names}, output=["templateid", "name"]
+            )
+            self._templateids = {t["name"]: int(t["templateid"]) for t in templates}
+            for name in names:
+                if name not in self._templateids:
+                    logging.error(f"Did not find template {name}")
 
-    # Logic that makes API call to zabbix to enroll a single host
-    def zabbix_enroll_node(self, ip, host_name, omnitik_groupid, omnitik_templateid):
-        # Check if Zabbix already knows about it
-        maybe_host = self.zapi.host.get(filter={"host": host_name})
+        default = self.snmp_rules.default.template
+        if default not in self._templateids:
+            raise ValueError(f"Did not find the default template {default}")
+        return self._templateids[default]
 
-        # Skip it if it already exists in zabbix
-        # TODO: Add a "force" option that could overwrite an existing
-        # host?
-        if len(maybe_host) > 0:
-            logging.warning(f"{host_name} ({ip}) already exists. Skipping.")
-            return
+    # Every host in the group, fetched a page at a time: the host IDs first
+    # (which stays small, even for a big group), then page_size hosts per
+    # host.get, with whatever else `params` asks for. host.get can't page by
+    # itself (there's no offset, and filter only matches exact values).
+    def get_group_hosts(self, groupid, page_size=None, **params):
+        if page_size is None:
+            page_size = self.zabbix_page_size
+        ids = self.zapi.host.get(groupids=[groupid], output=["hostid"])
+        hostids = sorted((h["hostid"] for h in ids), key=int)
+        hosts = []
+        for i in range(0, len(hostids), page_size):
+            hosts += self.zapi.host.get(hostids=hostids[i : i + page_size], **params)
+        return hosts
 
-        new_snmp_host = self.zapi.host.create(
-            host=host_name,
-            interfaces=[
+    # Pull every host in the group, along with its interfaces
+    @metrics.timed("zabbix_host_index")
+    def get_host_index(self, groupid):
+        hosts = self.get_group_hosts(
+            groupid,
+            output=["hostid", "host", "status"],
+            selectInterfaces=["interfaceid", "ip"],
+        )
+        host_index = O2ZHostIndex(hosts)
+        logging.info(f"Found {len(host_index)} hosts already in Zabbix")
+        return host_index
+
+    # The host object that host.create wants for a router monitored over SNMP.
+    # With the router's system info (from resolve_system_info()), the
+    # template and SNMP settings come from the first matching rule in the
+    # SNMP rules table, and its location and OS go in its inventory.
+    def snmp_host_params(
+        self, ip, host_name, omnitik_groupid, omnitik_templateid, info=None
+    ):
+        rule = self.snmp_rules.match(info)
+        if info is not None and self._templateids is not None:
+            omnitik_templateid = self._templateids.get(
+                rule.template, omnitik_templateid
+            )
+
+        params = {
+            "host": host_name,
+            "interfaces": [
                 {
                     "type": 2,
                     "main": 1,
@@ -64,34 +149,155 @@ class O2ZZabbix:
                     "dns": "",
                     "port": 161,
                     "details": {
-                        "version": 2,
+                        "version": rule.version,
                         "bulk": 1,
-                        "community": "public",
+                        "community": rule.community,
                     },
                 }
             ],
-            groups=[
+            "groups": [
                 {
                     "groupid": omnitik_groupid,
                 }
             ],
-            templates=[
+            "templates": [
                 {
                     "templateid": omnitik_templateid,
                 }
             ],
+        }
+
+        inventory = {}
+        if info is not None and info.get("sysLocation"):
+            inventory["location"] = info["sysLocation"]
+        if info is not None and info.get("sysDescr"):
+            inventory["os"] = info["sysDescr"][:128]
+        if len(inventory) > 0:
+            params["inventory_mode"] = 0
+            params["inventory"] = inventory
+        return params
+
+    # Logic that makes API call to zabbix to enroll a single host
+    @metrics.timed("zabbix_enroll_node")
+    def zabbix_enroll_node(
+        self,
+        ip,
+        host_name,
+        omnitik_groupid,
+        omnitik_templateid,
+        host_index=None,
+        info=None,
+    ):
+        # Check if Zabbix already knows about it
+        if host_index is not None and host_index.has_name(host_name):
+            maybe_host = [host_index.by_name[host_name]]
+        else:
+            maybe_host = self.zapi.host.get(filter={"host": host_name})
+
+        # Skip it if it already exists in zabbix
+        # TODO: Add a "force" option that could overwrite an existing
+        # host?
+        if len(maybe_host) > 0:
+            logging.warning(f"{host_name} ({ip}) already exists. Skipping.")
+            return
+
+        new_snmp_host = self.zapi.host.create(
+            **self.snmp_host_params(
+                ip, host_name, omnitik_groupid, omnitik_templateid, info
+            )
         )
         hostid = new_snmp_host["hostids"][0]
+        metrics.count("hosts_enrolled")
         return hostid
 
+    # Which of `host_names` Zabbix already has, in one call
+    def get_existing_host_names(self, host_names):
+        host_names = list(host_names)
+        if len(host_names) == 0:
+            return set()
+        existing = self.zapi.host.get(
+            filter={"host": host_names}, output=["hostid", "host"]
+        )
+        return {h["host"] for h in existing}
+
+    # Create a bunch of hosts. `pending` is a list of (ip, host_name, info),
+    # where info is the router's system info, or None.
+    # Hosts are created chunk_size at a time by passing several host objects
+    # to one host.create call. Zabbix creates a chunk all-or-nothing, so if a
+    # chunk fails, its hosts are retried one by one to find the bad one.
+    # Returns a dict of host_name -> hostid, or the exception that was raised
+    # for that host.
+    def create_hosts(
+        self, pending, omnitik_groupid, omnitik_templateid, chunk_size=None
+    ):
+        if chunk_size is None:
+            chunk_size = self.zabbix_chunk_size
+        results = {}
+        for i in range(0, len(pending), chunk_size):
+            chunk = pending[i : i + chunk_size]
+            params = [
+                self.snmp_host_params(
+                    ip, host_name, omnitik_groupid, omnitik_templateid, info
+                )
+                for ip, host_name, info in chunk
+            ]
+            try:
+                new_snmp_hosts = self.zapi.host.create(*params)
+                for (_, host_name, _), hostid in zip(chunk, new_snmp_hosts["hostids"]):
+                    results[host_name] = hostid
+            except ZabbixAPIException as err:
+                logging.warning(
+                    f"Could not create {len(chunk)} hosts in one call ({err}). "
+                    "Retrying them one by one."
+                )
+                for p in params:
+                    try:
+                        results[p["host"]] = self.zapi.host.create(**p)["hostids"][0]
+                    except ZabbixAPIException as host_err:
+                        logging.error(f"Could not enroll {p['host']}: {host_err}")
+                        results[p["host"]] = host_err
+                        metrics.error("enroll_create")
+        metrics.count(
+            "hosts_enrolled",
+            sum(1 for r in results.values() if not isinstance(r, Exception)),
+        )
+        return results
+
+    # Get the SNMP system info (sysName, sysDescr, sysObjectID, sysLocation)
+    # of a bunch of routers, through the hostname cache. Only the routers the
+    # cache doesn't know about (or all of them, with refresh=True) are asked
+    # over SNMP.
+    # Returns a dict of IP -> system info, or the exception for that router.
+    def resolve_system_info(self, ips, refresh=False):
+        ips = list(ips)
+        infos = {} if refresh else self.hostname_cache.get_many(ips)
+        missing = [ip for ip in ips if ip not in infos]
+
+        logging.info(f"Getting SNMP system info for {len(missing)} routers...")
+        resolved = snmp.snmp_get_system_info(
+            missing,
+            concurrency=self.snmp_concurrency,
+            timeout=self.snmp_timeout,
+            retries=self.snmp_retries,
+            port=self.snmp_port,
+            community=self.snmp_community,
+        )
+        self.hostname_cache.put_many(resolved)
+        infos.update(resolved)
+        return infos
+
     # Enroll a single device in zabbix
-    def enroll_device(self, ip):
+    def enroll_device(self, ip, refresh_snmp=False):
         # Get groupid and templateid in preparation
         omnitik_groupid = self.get_or_create_hostgroup()
         omnitik_templateid = self.get_generic_snmp_templateid()
-        host_name = snmp.snmp_get_hostname(ip)
+        info = self.resolve_system_info([ip], refresh=refresh_snmp)[ip]
+        self.hostname_cache.log_stats()
+        if isinstance(info, Exception):
+            raise info
+        host_name = info["sysName"]
         hostid = self.zabbix_enroll_node(
-            ip, host_name, omnitik_groupid, omnitik_templateid
+            ip, host_name, omnitik_groupid, omnitik_templateid, info=info
         )
         if hostid is not None:
             logging.info(f"{host_name} ({ip}) enrolled as hostid {hostid}")
@@ -108,34 +314,99 @@ class O2ZZabbix:
     #           Set up monitoring template, add a Slack alert thingy
     #           Add some kind of annotation for common name, "Grand St, SN3, etc"
     # Profit
-    def enroll_popular_devices(self, link_floor):
+    # With incremental=True, only the routers that are new or have crossed
+    # the link floor since the last run are looked at.
+    # With critical set, routers are picked by how many other routers their
+    # failure would cut off from the rest of the mesh (at least `critical`),
+    # instead of by link count.
+    # With resume=True, pick up where an interrupted run stopped (see
+    # O2ZEnrollment).
+    def enroll_popular_devices(
+        self,
+        link_floor,
+        offline=False,
+        incremental=False,
+        refresh_snmp=False,
+        critical=None,
+        resume=False,
+    ):
         e = O2ZExplorer()
-        # Fetch JSON data from the URL
+        # Fetch JSON data from the URL, and get the number of links that each
+        # node has
         logging.info("Getting OSPF Data...")
         try:
-            json_data = e.fetch_ospf_json()
+            route_dict = e.fetch_ospf_routes(offline)
+            if route_dict is None:
+                return
         except Exception as err:
             print("An exception occured fetching OSPF data!")
             print(err)
             return
 
-        # Get the number of links that each node has
-        route_dict = e.extract_routes_count(json_data)
+        all_routes = route_dict
+        if critical is not None:
+            topology = e.load_ospf_topology()
+            cuts = topology.articulation_points()
+            # Critical routers are few, so there's no point in only looking
+            # at what changed
+            route_dict = {ip: cuts[ip] for ip in topology.critical(critical)}
+            link_floor = critical
+            logging.info(
+                f"{len(route_dict)} routers would cut off at least {critical} others"
+            )
+        elif incremental:
+            diff = e.diff_routes_count(e.load_previous_routes(), route_dict, link_floor)
+            route_dict = {
+                ip: route_dict[ip] for ip in {**diff["new"], **diff["crossed"]}
+            }
+            logging.info(
+                f"{len(diff['new'])} new, {len(diff['crossed'])} crossed, "
+                f"{len(diff['dropped'])} dropped since the last run"
+            )
 
         # Get groupid and templateid in preparation
         omnitik_groupid = self.get_or_create_hostgroup()
         omnitik_templateid = self.get_generic_snmp_templateid()
 
-        for ip, ct in route_dict.items():
-            # Do nothing if the device does not have enough links
-            if ct < link_floor:
-                continue
+        # See what Zabbix already has, so we don't bother those routers
+        host_index = self.get_host_index(omnitik_groupid)
 
-            host_name = snmp.snmp_get_hostname(ip)
+        # Do nothing with devices that do not have enough links, or that
+        # are already monitored
+        popular = {
+            ip: ct
+            for ip, ct in route_dict.items()
+            if ct >= link_floor and not host_index.has_ip(ip)
+        }
 
-            logging.info(f"Host: {host_name}, Router: {ip}, Links: {ct}")
-            hostid = self.zabbix_enroll_node(
-                ip, host_name, omnitik_groupid, omnitik_templateid
-            )
-            if hostid is not None:
-                logging.info(f"{host_name} enrolled as hostid {hostid}")
+        # Resolve, check and create them in a pipeline, so the SNMP lookups
+        # and the API calls overlap, and one bad router doesn't sink the run
+        enrollment = O2ZEnrollment(
+            self,
+            omnitik_groupid,
+            omnitik_templateid,
+            host_index,
+            refresh_snmp=refresh_snmp,
+            measure="Strands" if critical is not None else "Links",
+        )
+        enrollment.run(popular, resume=resume)
+
+        # Leave out the routers that failed, so the next incremental run sees
+        # them as new and tries them again
+        e.save_previous_routes(
+            {ip: ct for ip, ct in all_routes.items() if ip not in enrollment.failed}
+        )
+        self.hostname_cache.log_stats()
+
+    # Disable the hosts in the group that OSPF can't see anymore, and delete
+    # the ones that have been gone for grace_days (see O2ZReconciler).
+    # With dry_run=True, only print what would happen.
+    def reconcile_hosts(self, offline=False, grace_days=None, dry_run=False):
+        e = O2ZExplorer()
+        logging.info("Getting OSPF Data...")
+        route_dict = e.fetch_ospf_routes(offline)
+        if route_dict is None:
+            return
+        return O2ZReconciler(self, grace_days=grace_days).reconcile(
+            route_dict.keys(), dry_run=dry_run
+        )
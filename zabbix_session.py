@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from packaging.version import Version
+from pyzabbix.api import ZabbixAPI, ZabbixAPIException
+from cache import cache_path
+from metrics import metrics
+
+# Methods that are safe to send again if we don't know whether Zabbix got them
+READ_ONLY_METHODS = {"apiinfo.version", "user.checkAuthentication"}
+
+# Statuses the frontend answers with when it's overloaded or restarting,
+# before it does anything with the request
+OVERLOADED_STATUSES = {429, 503}
+# Statuses from a proxy in front of the frontend, which might have done it
+GATEWAY_STATUSES = {502, 504}
+
+
+# A Zabbix API client that's cheaper to start and kinder to a loaded frontend
+# than a bare ZabbixAPI:
+#    - Requests go over one pooled keep-alive session. Failed connections,
+#      overload statuses and, for read-only methods, timeouts are retried
+#      with exponential backoff.
+#    - The API version and the session token from user.login are cached on
+#      disk (in P2Z_CACHE_DIR), so the next run can skip both round trips.
+#      The token is reused until Zabbix says it's expired, and then we log
+#      in again.
+#    - Zabbix API tokens (P2Z_ZABBIX_API_TOKEN) skip logging in altogether.
+class O2ZZabbixSession(ZabbixAPI):
+    def __init__(self, url, timeout=None, retries=None, backoff=None, path=None):
+        if timeout is None:
+            timeout = float(os.getenv("P2Z_ZABBIX_TIMEOUT", default=30))
+        if retries is None:
+            retries = int(os.getenv("P2Z_ZABBIX_RETRIES", default=3))
+        if backoff is None:
+            backoff = float(os.getenv("P2Z_ZABBIX_BACKOFF", default=0.5))
+        self.retries = retries
+        self.backoff = backoff
+        self.path = cache_path("zabbix_session.json") if path is None else path
+
+        # urllib3 only retries what certainly never reached Zabbix. Everything
+        # else is decided per JSON-RPC method in do_request.
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=int(os.getenv("P2Z_ZABBIX_POOL_SIZE", default=4)),
+            max_retries=Retry(
+                total=None,
+                connect=retries,
+                read=0,
+                status=0,
+                other=0,
+                backoff_factor=backoff,
+            ),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        super().__init__(url, session=session, timeout=timeout)
+
+        self._user = None
+        self._password = None
+        # Whether self.version came from the cache rather than from asking
+        self._version_cached = False
+
+    # Log in with an API token, or with a username and password, reusing the
+    # cached session token if there is one
+    def connect(self, user=None, password=None, api_token=None):
+        state = self._load_state()
+        if state.get("version"):
+            self.version = Version(state["version"])
+            self._detect_version = False
+            self._version_cached = True
+
+        if api_token:
+            self.login(api_token=api_token)
+        elif state.get("user") == user and state.get("auth"):
+            logging.info("Reusing cached Zabbix session")
+            metrics.cache("zabbix_session", hits=1)
+            self._user, self._password = user, password
+            self.auth = state["auth"]
+        else:
+            metrics.cache("zabbix_session", misses=1)
+            self._user, self._password = user, password
+            self.login(user, password)
+        self._save_state()
+
+    # Log in again after the cached session token expired. Zabbix might have
+    # been upgraded since we cached its version, so ask for it again too.
+    def relogin(self):
+        logging.info("Zabbix session expired. Logging in again...")
+        self._detect_version = True
+        self._version_cached = False
+        self.login(self._user, self._password)
+        self._save_state()
+
+    # Ask for the API version again, in case the cached one is from before an
+    # upgrade (and is making us send the API token the wrong way)
+    def redetect_version(self):
+        self._version_cached = False
+        self.version = Version(self.api_version())
+        logging.info(f"Zabbix API version is now {self.version}")
+        self._save_state()
+
+    def do_request(self, method, params=None):
+        metrics.count("zabbix_api_calls")
+        try:
+            return self._do_request_retrying(method, params)
+        except ZabbixAPIException as e:
+            if not _is_auth_error(e):
+                raise
+            # Only a session we logged in to ourselves can expire, but a
+            # cached version can be stale whichever way we logged in
+            if self._password is not None:
+                self.relogin()
+            elif self._version_cached:
+                self.redetect_version()
+            else:
+                raise
+            return self._do_request_retrying(method, params)
+
+    def _do_request_retrying(self, method, params):
+        read_only = method in READ_ONLY_METHODS or method.endswith(".get")
+        for attempt in range(self.retries + 1):
+            try:
+                return super().do_request(method, params)
+            except requests.exceptions.HTTPError as e:
+                status = e.response.status_code
+                if status not in OVERLOADED_STATUSES and not (
+                    read_only and status in GATEWAY_STATUSES
+                ):
+                    raise
+                error = e
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                # We can't tell whether Zabbix already did it, so only try
+                # again if doing it twice doesn't matter
+                # (urllib3 already retried connections that never got made)
+                if not read_only:
+                    raise
+                error = e
+
+            if attempt == self.retries:
+                raise error
+            delay = self.backoff * 2**attempt
+            logging.warning(f"{method} failed ({error}). Retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def _load_state(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # A cache from some other Zabbix is no use to us
+        if state.get("url") != self.url:
+            return {}
+        return state
+
+    # The session token is as good as a password while it lasts, so only we
+    # get to read it
+    def _save_state(self):
+        state = {
+            "url": self.url,
+            "version": str(self.version) if self.version else None,
+        }
+        if not self.use_api_token:
+            state.update({"user": self._user, "auth": self.auth})
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+
+def _is_auth_error(e):
+    error = e.error or {}
+    message = f"{error.get('message', '')} {error.get('data', '')}".lower()
+    return "re-login" in message or "not authori" in message